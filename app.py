@@ -1,35 +1,83 @@
-import os
-from flask import Flask
-from flask_migrate import Migrate
-from flask_login import LoginManager
-from flask_bcrypt import Bcrypt
-from dotenv import load_dotenv
-from config import Config
-from models import db, User
+from startup import StartupTimer, warm_up
 
-load_dotenv()
+startup_timer = StartupTimer()
 
-app = Flask(__name__)
-app.config.from_object(Config)
+with startup_timer.step('import flask extensions'):
+    import os
+    from flask import Flask
+    from flask_migrate import Migrate
+    from flask_login import LoginManager
+    from flask_bcrypt import Bcrypt
+    from dotenv import load_dotenv
+    from config import Config
+with startup_timer.step('import models'):
+    from models import db
+with startup_timer.step('import services'):
+    from model_registry import model_registry
+    from inference_queue import inference_dispatcher
+    from prediction_cache import prediction_cache
+    from user_cache import user_cache
+    from page_cache import page_cache
+    from storage import upload_storage
+    from jobs import job_runner
+    import rollups
+    import retraining
+    import bulk_import
+    import storage_maintenance
+    import metrics
 
-# UPLOAD_FOLDERの設定
-UPLOAD_FOLDER = os.path.join(os.getcwd(), os.getenv('UPLOAD_FOLDER', 'uploads'))
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+load_dotenv()
 
-db.init_app(app)
-migrate = Migrate(app, db)
-bcrypt = Bcrypt(app)
+migrate = Migrate()
+bcrypt = Bcrypt()
 login_manager = LoginManager()
-login_manager.init_app(app)
-login_manager.login_view = 'login'
+login_manager.login_view = 'main.login'
 login_manager.login_message = ""  # ここでメッセージを無効にする
 login_manager.login_message_category = "info"
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    # 一定時間はDBを参照せずキャッシュから復元する（settings で更新したら破棄する）
+    return user_cache.get(int(user_id))
+
+
+def create_app(config_object=Config):
+    app = Flask(__name__)
+    app.config.from_object(config_object)
+
+    # UPLOAD_FOLDERの設定
+    UPLOAD_FOLDER = os.path.join(os.getcwd(), os.getenv('UPLOAD_FOLDER', 'uploads'))
+    app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+
+    with startup_timer.step('init extensions'):
+        db.init_app(app)
+        migrate.init_app(app, db)
+        bcrypt.init_app(app)
+        login_manager.init_app(app)
+        model_registry.init_app(app)
+        inference_dispatcher.init_app(app)
+        prediction_cache.init_app(app)
+        user_cache.init_app(app)
+        page_cache.init_app(app)
+        upload_storage.init_app(app)
+        job_runner.init_app(app)
+        rollups.init_app(app)
+        retraining.init_app(app)
+        bulk_import.init_app(app)
+        storage_maintenance.init_app(app)
+        metrics.init_app(app)
+
+    with startup_timer.step('import views'):
+        from views import bp
+        app.register_blueprint(bp)
+
+    if app.config['MODEL_PRELOAD']:
+        # gunicorn --preload と併用するとワーカー間でモデルを共有できる
+        warm_up(app, startup_timer)
+
+    app.logger.info(startup_timer.report())
+    return app
 
-from views import *
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    create_app().run(debug=True)
@@ -0,0 +1,303 @@
+"""アップロード → 推論 → 保存 のホットパスのベンチマーク
+
+ローカルのSQLiteを使い、段階ごとのレイテンシ、Flaskテストクライアント経由の
+同時実行数ごとのスループット、ピークRSSを計測してJSONに保存する。
+
+    python benchmarks/bench_upload.py --output bench_before.json
+    python benchmarks/bench_upload.py --output bench_after.json --baseline bench_before.json
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+DEFAULT_RESOLUTIONS = '640x480,1920x1080,4032x3024'
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='アップロード処理のベンチマーク')
+    parser.add_argument('--output', default='bench_results.json', help='結果を保存するJSONファイル')
+    parser.add_argument('--baseline', help='比較対象の結果JSON')
+    parser.add_argument('--data-dir', default=os.path.join(ROOT, 'dataset', 'normal'), help='サンプル画像のディレクトリ')
+    parser.add_argument('--samples', type=int, default=10, help='使用するサンプル画像の枚数')
+    parser.add_argument('--resolutions', default=DEFAULT_RESOLUTIONS, help='合成画像の解像度（カンマ区切り）')
+    parser.add_argument('--repeat', type=int, default=5, help='段階ごとの計測で各画像を処理する回数')
+    parser.add_argument('--concurrency', default='1,4,8', help='エンドツーエンド計測の同時実行数（カンマ区切り）')
+    parser.add_argument('--requests', type=int, default=40, help='同時実行数ごとのリクエスト数')
+    parser.add_argument('--allow-cache', action='store_true',
+                        help='同じ画像を送る（既定では毎回内容を変えて判定結果キャッシュを避ける）')
+    return parser.parse_args()
+
+
+def summarize(samples):
+    values = np.asarray(samples) * 1000.0
+    return {
+        'count': int(values.size),
+        'mean_ms': float(values.mean()),
+        'p50_ms': float(np.percentile(values, 50)),
+        'p90_ms': float(np.percentile(values, 90)),
+        'p99_ms': float(np.percentile(values, 99)),
+        'max_ms': float(values.max()),
+    }
+
+
+def synthetic_jpeg(width, height, seed):
+    from PIL import Image as PILImage
+    # 尿サンプルの写真に近い、なだらかな色の変化とノイズを持つ画像。
+    # 大きな解像度でもメモリを食わないよう、縮小版を拡大してからノイズを重ねる
+    rng = np.random.default_rng(seed)
+    small_width, small_height = max(width // 16, 8), max(height // 16, 8)
+    y, x = np.mgrid[0:small_height, 0:small_width]
+    base = np.stack([
+        200 + 40 * np.sin(x / small_width * np.pi),
+        180 + 50 * np.cos(y / small_height * np.pi),
+        60 + 30 * np.sin((x + y) / (small_width + small_height) * np.pi),
+    ], axis=-1) + rng.normal(0, 4, (small_height, small_width, 3))
+    image = PILImage.fromarray(np.clip(base, 0, 255).astype(np.uint8)).resize((width, height), PILImage.BICUBIC)
+    noise = PILImage.effect_noise((width, height), 32).convert('RGB')
+    image = PILImage.blend(image, noise, 0.08)
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=90)
+    return buffer.getvalue()
+
+
+def load_images(args):
+    images = []
+    names = sorted(os.listdir(args.data_dir)) if os.path.isdir(args.data_dir) else []
+    # 画像以外のファイル（.DS_Store など）で枚数を消費しないよう、絞り込んでから先頭を使う
+    names = [name for name in names if os.path.isfile(os.path.join(args.data_dir, name))
+             and os.path.splitext(name)[1].lower() in ('.jpg', '.jpeg', '.png')][:args.samples]
+    for name in names:
+        with open(os.path.join(args.data_dir, name), 'rb') as f:
+            images.append((f'sample:{name}', f.read()))
+    for index, resolution in enumerate(args.resolutions.split(',')):
+        width, height = (int(value) for value in resolution.split('x'))
+        images.append((f'synthetic:{resolution}', synthetic_jpeg(width, height, index)))
+    return images
+
+
+def ensure_models(workdir):
+    # 学習済みモデルがなければ合成データで小さなモデルを作る
+    pca_path = os.getenv('PCA_MODEL_PATH', os.path.join(ROOT, 'pca_model.pkl'))
+    iso_forest_path = os.getenv('ISO_FOREST_MODEL_PATH', os.path.join(ROOT, 'iso_forest_model.pkl'))
+    if os.path.exists(pca_path) and os.path.exists(iso_forest_path):
+        return pca_path, iso_forest_path
+
+    import joblib
+    from sklearn.decomposition import PCA
+    from sklearn.ensemble import IsolationForest
+    from preprocessing import FEATURE_SIZE
+    rng = np.random.default_rng(0)
+    data = rng.random((120, FEATURE_SIZE), dtype=np.float32)
+    pca = PCA(n_components=50, svd_solver='randomized').fit(data)
+    iso_forest = IsolationForest(contamination=0.1, random_state=0).fit(pca.transform(data))
+    pca_path = os.path.join(workdir, 'pca_model.pkl')
+    iso_forest_path = os.path.join(workdir, 'iso_forest_model.pkl')
+    joblib.dump(pca, pca_path)
+    joblib.dump(iso_forest, iso_forest_path)
+    return pca_path, iso_forest_path
+
+
+def bench_stages(app, images, repeat):
+    from features import FEATURE_EXTRACTORS
+    from models import db, Image, Result, now_jst, User
+    from model_registry import model_registry
+    from preprocessing import decode_image
+    from rollups import record_results
+
+    model = model_registry.get()
+    # 本番と同じ関数を計測する。特徴量は読み込んだモデルのもの（features）に加え、各抽出器も計測する
+    stages = {name: [] for name in ('decode', 'features', 'pca_transform', 'predict',
+                                     'db_image_commit', 'db_result_commit')}
+    for mode in FEATURE_EXTRACTORS:
+        stages[f'features_{mode}'] = []
+    per_image = {}
+    with app.app_context():
+        user_id = User.query.first().id
+        for label, data in images:
+            totals = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+
+                t = time.perf_counter()
+                image = decode_image(io.BytesIO(data))
+                stages['decode'].append(time.perf_counter() - t)
+
+                # 最終的なリサイズと、pixels なら正規化、color なら色ヒストグラムと統計量の計算
+                t = time.perf_counter()
+                vector = model.features.from_image(image)
+                stages['features'].append(time.perf_counter() - t)
+
+                t = time.perf_counter()
+                projected = vector[np.newaxis, :]
+                if model.pca is not None:
+                    projected = model.pca.transform(projected)
+                stages['pca_transform'].append(time.perf_counter() - t)
+
+                t = time.perf_counter()
+                prediction = model.iso_forest.predict(projected)
+                stages['predict'].append(time.perf_counter() - t)
+
+                t = time.perf_counter()
+                image_row = Image(filename='bench.jpg', user_id=user_id)
+                db.session.add(image_row)
+                db.session.commit()
+                stages['db_image_commit'].append(time.perf_counter() - t)
+
+                t = time.perf_counter()
+                result = Result(status='正常' if prediction[0] == 1 else '異常', user_id=user_id,
+                                date=now_jst(), model_version=model.version, image_id=image_row.id)
+                db.session.add(result)
+                record_results([result])
+                db.session.commit()
+                stages['db_result_commit'].append(time.perf_counter() - t)
+
+                totals.append(time.perf_counter() - started)
+
+                # 合計には含めず、抽出器ごとの時間を計測する
+                for mode, extractor in FEATURE_EXTRACTORS.items():
+                    t = time.perf_counter()
+                    extractor.from_image(image)
+                    stages[f'features_{mode}'].append(time.perf_counter() - t)
+            per_image[label] = {'bytes': len(data), 'total': summarize(totals)}
+    return {name: summarize(samples) for name, samples in stages.items()}, per_image
+
+
+def bench_end_to_end(app, images, concurrency, total_requests, allow_cache):
+    counter = iter(range(1 << 62))
+
+    def make_client():
+        client = app.test_client()
+        client.post('/login', data={'username': 'bench', 'password': 'bench123'})
+        return client
+
+    clients = [make_client() for _ in range(concurrency)]
+
+    def run(index):
+        client = clients[index % concurrency]
+        label, data = images[index % len(images)]
+        if not allow_cache:
+            # JPEGの末尾にバイトを足して内容ハッシュだけを変える（デコード結果は同じ）
+            data = data + str(next(counter)).encode()
+        started = time.perf_counter()
+        response = client.post('/upload_image', data={'image': (io.BytesIO(data), 'bench.jpg')},
+                               content_type='multipart/form-data')
+        elapsed = time.perf_counter() - started
+        ok = response.status_code == 200 and 'error' not in response.get_json()
+        return elapsed, ok
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        outcomes = list(executor.map(run, range(total_requests)))
+    wall = time.perf_counter() - started
+    latencies = [elapsed for elapsed, _ in outcomes]
+    return {
+        'concurrency': concurrency,
+        'requests': total_requests,
+        'errors': sum(1 for _, ok in outcomes if not ok),
+        'throughput_rps': total_requests / wall,
+        'latency': summarize(latencies),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                              capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def print_comparison(report, baseline_path):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    print(f'\n比較: {baseline_path} ({baseline["meta"].get("git_revision")}) → 今回')
+    for name, stats in report['stages'].items():
+        before = baseline.get('stages', {}).get(name)
+        if before:
+            print(f'  {name:18s} p50 {before["p50_ms"]:8.2f}ms → {stats["p50_ms"]:8.2f}ms')
+    before_runs = {run['concurrency']: run for run in baseline.get('end_to_end', [])}
+    for run in report['end_to_end']:
+        before = before_runs.get(run['concurrency'])
+        if before:
+            print(f'  concurrency={run["concurrency"]:<3d} {before["throughput_rps"]:8.1f} → '
+                  f'{run["throughput_rps"]:8.1f} req/s')
+    print(f'  peak RSS {baseline["peak_rss_mb"]:.1f}MB → {report["peak_rss_mb"]:.1f}MB')
+
+
+def main():
+    args = parse_args()
+    workdir = tempfile.mkdtemp(prefix='bench_upload_')
+    pca_path, iso_forest_path = ensure_models(workdir)
+
+    # app をインポートする前に、ベンチマーク用のDBと保存先を設定する
+    os.environ['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{os.path.join(workdir, "bench.db")}'
+    os.environ['UPLOAD_FOLDER'] = os.path.join(workdir, 'uploads')
+    os.environ['PCA_MODEL_PATH'] = pca_path
+    os.environ['ISO_FOREST_MODEL_PATH'] = iso_forest_path
+    # 公開中のマニフェストではなく、上のモデルの組を使う
+    os.environ['MODEL_MANIFEST_PATH'] = os.path.join(workdir, 'model_manifest.json')
+
+    from app import create_app, bcrypt
+    from models import db, User
+    app = create_app()
+    app.config['WTF_CSRF_ENABLED'] = False
+    with app.app_context():
+        db.create_all()
+        db.session.add(User(username='bench', password=bcrypt.generate_password_hash('bench123').decode('utf-8'),
+                            birthdate=date(1990, 1, 1), height=170, weight=60))
+        db.session.commit()
+
+    images = load_images(args)
+    print(f'{len(images)}枚の画像で計測します (作業ディレクトリ: {workdir})')
+
+    stages, per_image = bench_stages(app, images, args.repeat)
+    for name, stats in stages.items():
+        print(f'  {name:18s} p50 {stats["p50_ms"]:8.2f}ms  p99 {stats["p99_ms"]:8.2f}ms')
+
+    end_to_end = []
+    for concurrency in (int(value) for value in args.concurrency.split(',')):
+        run = bench_end_to_end(app, images, concurrency, args.requests, args.allow_cache)
+        end_to_end.append(run)
+        print(f'  concurrency={concurrency:<3d} {run["throughput_rps"]:8.1f} req/s  '
+              f'p50 {run["latency"]["p50_ms"]:.1f}ms  p99 {run["latency"]["p99_ms"]:.1f}ms  errors {run["errors"]}')
+    app.extensions['upload_storage'].shutdown()
+
+    report = {
+        'meta': {
+            'created_at': datetime.now().isoformat(),
+            'git_revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'args': vars(args),
+        },
+        'stages': stages,
+        'per_image': per_image,
+        'end_to_end': end_to_end,
+        # Linuxでは ru_maxrss はKB単位
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f'結果を保存しました: {args.output} (peak RSS {report["peak_rss_mb"]:.1f}MB)')
+
+    if args.baseline:
+        print_comparison(report, args.baseline)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,203 @@
+import bisect
+import csv
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+from models import db, User, Image, Result, JST, now_jst
+from inference import predict_statuses
+from storage import UploadStorage
+from rollups import record_results
+import jobs
+
+import_cli = AppGroup('images', help='画像の一括取り込み')
+
+# ワーカープロセス内で原本を保存する先
+_worker_storage = None
+
+
+def init_app(app):
+    app.cli.add_command(import_cli)
+
+
+def _init_worker(upload_folder, *registry_args):
+    global _worker_storage
+    jobs._init_worker(*registry_args)
+    _worker_storage = UploadStorage()
+    _worker_storage.root = upload_folder
+
+
+def _score_files(paths):
+    # ワーカープロセスで読み込み・保存・前処理を行い、まとめて1回で推論する。
+    # paths の順に (パス, 内容ハッシュ, 保存先, 更新日時, ステータス, モデルのバージョン, エラー) を返す
+    import numpy as np
+    from preprocessing import decode_image
+    model = jobs._worker_registry.get()
+    rows, vectors = [], []
+    for path in paths:
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            vector = model.features.from_image(decode_image(io.BytesIO(data)))
+            content_hash = hashlib.sha256(data).hexdigest()
+            storage_path = _worker_storage.save(data, content_hash, os.path.splitext(path)[1])
+            rows.append([path, content_hash, storage_path, os.stat(path).st_mtime, None, model.version, None])
+            vectors.append(vector)
+        except Exception as e:
+            rows.append([path, None, None, None, None, None, f'{type(e).__name__}: {e}'])
+    if vectors:
+        statuses = iter(predict_statuses(model, np.stack(vectors)))
+        for row in rows:
+            if row[6] is None:
+                row[4] = next(statuses)
+    return rows
+
+
+def list_files(directory):
+    # ディレクトリ以下の画像を、再開位置を決められるよう相対パスの順に並べて返す
+    from views import allowed_file
+    paths = []
+    for root, dirs, filenames in os.walk(directory):
+        dirs.sort()
+        for filename in filenames:
+            if allowed_file(filename):
+                paths.append(os.path.relpath(os.path.join(root, filename), directory))
+    paths.sort()
+    return paths
+
+
+def load_checkpoint(path, key):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f).get(key, {})
+
+
+def save_checkpoint(path, key, progress):
+    checkpoints = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            checkpoints = json.load(f)
+    checkpoints[key] = progress
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(checkpoints, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+
+
+def insert_batch(user_id, rows, use_mtime):
+    # 1バッチ分の画像と結果を1つのトランザクションで追加する。
+    # 中断後の再開で同じ画像を二重に登録しないよう、登録済みの内容ハッシュは飛ばす
+    hashes = {row[1] for row in rows}
+    existing = {content_hash for content_hash, in db.session.query(Image.content_hash)
+                .filter(Image.user_id == user_id, Image.content_hash.in_(hashes))}
+    # アップロード時と同じく、Image.date はUTC、Result.date は日本時間で記録する
+    now_utc, now = datetime.utcnow(), now_jst()
+    new_results = []
+    for path, content_hash, storage_path, mtime, status, model_version, _ in rows:
+        if content_hash in existing:
+            continue
+        existing.add(content_hash)
+        if use_mtime:
+            image_date = datetime.utcfromtimestamp(mtime)
+            result_date = datetime.fromtimestamp(mtime, JST).replace(tzinfo=None)
+        else:
+            image_date, result_date = now_utc, now
+        image = Image(filename=os.path.basename(path)[:100], content_hash=content_hash,
+                      storage_path=storage_path, user_id=user_id, date=image_date)
+        new_results.append(Result(status=status, user_id=user_id, date=result_date,
+                                  model_version=model_version, image=image))
+    db.session.add_all(new_results)
+    record_results(new_results)
+    db.session.commit()
+    return len(new_results)
+
+
+@import_cli.command('import')
+@click.argument('directory', type=click.Path(exists=True, file_okay=False))
+@click.option('--user', 'username', required=True, help='取り込み先のユーザー名')
+@click.option('--workers', type=int, default=os.cpu_count(), help='デコードと推論に使うプロセス数')
+@click.option('--chunk-size', type=int, default=32, help='ワーカーが1回に処理する画像数')
+@click.option('--batch-size', type=int, default=500, help='1回のコミットで追加する画像数')
+@click.option('--checkpoint', default='import_checkpoint.json', help='再開位置を記録するファイル')
+@click.option('--restart', is_flag=True, help='記録された再開位置を無視して最初から取り込む')
+@click.option('--date', 'date_source', type=click.Choice(['mtime', 'now']), default='mtime',
+              help='検査日時: mtime はファイルの更新日時、now は取り込んだ日時')
+@click.option('--results-csv', default=None, help='ファイルごとの判定結果を追記するCSV')
+def import_command(directory, username, workers, chunk_size, batch_size, checkpoint, restart, date_source,
+                   results_csv):
+    """ディレクトリ以下の画像を判定し、画像と検査結果をまとめて登録する"""
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        raise click.ClickException(f'ユーザーが見つかりません: {username}')
+    user_id = user.id
+
+    directory = os.path.realpath(directory)
+    key = f'{user_id}:{directory}'
+    progress = {} if restart else load_checkpoint(checkpoint, key)
+    paths = list_files(directory)
+    # 再開時は最後にコミットしたファイルの次から処理する
+    start = bisect.bisect_right(paths, progress['last_path']) if progress.get('last_path') else 0
+    progress.setdefault('imported', 0)
+    progress.setdefault('skipped', 0)
+    progress.setdefault('failed', 0)
+    remaining = paths[start:]
+    click.echo(f'{len(paths)}枚中{len(remaining)}枚を取り込みます (workers={workers}, batch={batch_size})')
+    if not remaining:
+        return
+
+    config = current_app.config
+    chunks = [[os.path.join(directory, path) for path in remaining[i:i + chunk_size]]
+              for i in range(0, len(remaining), chunk_size)]
+    csv_file = open(results_csv, 'a', newline='') if results_csv else None
+    writer = csv.writer(csv_file) if csv_file else None
+    started = time.perf_counter()
+    processed = 0
+    pending = []
+    try:
+        with ProcessPoolExecutor(
+                max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_worker,
+                initargs=(config['UPLOAD_FOLDER'], config['MODEL_ENGINE'], config['PCA_MODEL_PATH'],
+                          config['ISO_FOREST_MODEL_PATH'], config['COMPILED_MODEL_PATH'],
+                          config['MODEL_MANIFEST_PATH'], config['MODEL_RELOAD_INTERVAL'])) as executor:
+            # map は投入順に結果を返すので、コミット済みの位置を最後のパスで表せる
+            for index, rows in enumerate(executor.map(_score_files, chunks)):
+                for row in rows:
+                    if row[6] is not None:
+                        click.echo(f'読み込みに失敗したためスキップします: {row[0]}: {row[6]}')
+                        progress['failed'] += 1
+                    else:
+                        pending.append(row)
+                    if writer:
+                        writer.writerow([os.path.relpath(row[0], directory), row[4] or '', row[5] or '', row[6] or ''])
+                processed += len(rows)
+
+                if len(pending) >= batch_size or index == len(chunks) - 1:
+                    inserted = insert_batch(user_id, pending, date_source == 'mtime') if pending else 0
+                    progress['imported'] += inserted
+                    progress['skipped'] += len(pending) - inserted
+                    progress['last_path'] = os.path.relpath(rows[-1][0], directory)
+                    pending = []
+                    if csv_file:
+                        csv_file.flush()
+                    save_checkpoint(checkpoint, key, progress)
+
+                    elapsed = time.perf_counter() - started
+                    rate = processed / elapsed if elapsed else 0.0
+                    eta = (len(remaining) - processed) / rate if rate else 0.0
+                    click.echo(f'{processed}/{len(remaining)}枚 {rate:.1f}枚/秒 残り約{eta:.0f}秒 '
+                               f'(登録 {progress["imported"]}, 重複 {progress["skipped"]}, 失敗 {progress["failed"]})')
+    finally:
+        if csv_file:
+            csv_file.close()
+    click.echo(f'取り込みが完了しました: {processed}枚 {time.perf_counter() - started:.1f}秒')
@@ -12,3 +12,40 @@ class Config:
     SQLALCHEMY_DATABASE_URI = uri
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     UPLOAD_FOLDER = os.path.join(os.getcwd(), 'uploads')  # 画像を保存するディレクトリ
+    UPLOAD_WRITER_THREADS = int(os.getenv("UPLOAD_WRITER_THREADS", "2"))  # 原本を書き込むスレッド数
+    # 保存領域のメンテナンス（flask storage maintain）
+    STORAGE_RECOMPRESS_AFTER_DAYS = int(os.getenv("STORAGE_RECOMPRESS_AFTER_DAYS", "30"))  # この日数を過ぎた原本を再圧縮する
+    STORAGE_RECOMPRESS_FORMAT = os.getenv("STORAGE_RECOMPRESS_FORMAT", "JPEG")  # JPEG または WEBP
+    STORAGE_RECOMPRESS_QUALITY = int(os.getenv("STORAGE_RECOMPRESS_QUALITY", "75"))
+    STORAGE_RECOMPRESS_MAX_EDGE = int(os.getenv("STORAGE_RECOMPRESS_MAX_EDGE", "1280"))  # 再圧縮時の長辺の上限(px)
+    STORAGE_GC_GRACE_HOURS = float(os.getenv("STORAGE_GC_GRACE_HOURS", "24"))  # 参照のないファイルを消すまでの猶予
+    STORAGE_IO_LIMIT_MB = float(os.getenv("STORAGE_IO_LIMIT_MB", "5"))  # 読み書きの上限(MB/秒)。0で無制限
+
+    # 推論モデルの設定
+    PCA_MODEL_PATH = os.getenv("PCA_MODEL_PATH", "pca_model.pkl")
+    ISO_FOREST_MODEL_PATH = os.getenv("ISO_FOREST_MODEL_PATH", "iso_forest_model.pkl")
+    # sklearn: pickleを読み込む / numpy: model_learning.py が書き出した .npz をメモリマップして推論する
+    MODEL_ENGINE = os.getenv("MODEL_ENGINE", "sklearn")
+    COMPILED_MODEL_PATH = os.getenv("COMPILED_MODEL_PATH", "model.npz")
+    MODEL_MANIFEST_PATH = os.getenv("MODEL_MANIFEST_PATH", "model_manifest.json")  # 公開中のモデル一式（あれば上のパスより優先）
+    MODEL_RELOAD_INTERVAL = float(os.getenv("MODEL_RELOAD_INTERVAL", "5"))  # 更新確認の間隔(秒)
+    MODEL_PRELOAD = os.getenv("MODEL_PRELOAD", "0") == "1"  # fork前にモデルを読み込む
+    # スレッドワーカー内の同時リクエストをまとめて推論する設定
+    INFERENCE_BATCHING = os.getenv("INFERENCE_BATCHING", "0") == "1"
+    INFERENCE_BATCH_WINDOW_MS = float(os.getenv("INFERENCE_BATCH_WINDOW_MS", "5"))  # まとめる待ち時間(ミリ秒)
+    INFERENCE_MAX_BATCH_SIZE = int(os.getenv("INFERENCE_MAX_BATCH_SIZE", "32"))
+    PREDICTION_CACHE_SIZE = int(os.getenv("PREDICTION_CACHE_SIZE", "10000"))  # 判定結果キャッシュの上限件数
+    # 非同期アップロード（ジョブとして受け付け、結果はポーリング/SSEで取得）
+    ASYNC_UPLOADS = os.getenv("ASYNC_UPLOADS", "0") == "1"
+    JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))  # 推論を行うプロセス数
+    JOB_QUEUE_LIMIT = int(os.getenv("JOB_QUEUE_LIMIT", "16"))  # 処理待ちジョブの上限（超えたら503）
+    JOB_TIMEOUT = int(os.getenv("JOB_TIMEOUT", "120"))  # この秒数を過ぎた未完了ジョブは失敗とする
+    # SSEの接続は完了まで1ワーカーを占有するため、gthread/geventなど同時接続を扱えるワーカーでだけ有効にする
+    JOB_EVENTS = os.getenv("JOB_EVENTS", "0") == "1"
+    JOB_EVENTS_MAX_SECONDS = int(os.getenv("JOB_EVENTS_MAX_SECONDS", "25"))  # 1回のSSE接続の上限(秒)
+    USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "1024"))  # ログインユーザーのキャッシュの上限件数（0で無効）
+    USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "60"))  # キャッシュしたユーザーの有効期間(秒)
+    PAGE_CACHE_SIZE = int(os.getenv("PAGE_CACHE_SIZE", "1024"))  # 検査記録の描画結果をキャッシュするユーザー数（0で無効）
+    HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "20"))  # 検査記録の1ページの件数
+    METRICS_TOKEN = os.getenv("METRICS_TOKEN")  # /metrics へのアクセスに必要なBearerトークン（未設定なら制限なし）
+    MAX_BATCH_UPLOAD_FILES = int(os.getenv("MAX_BATCH_UPLOAD_FILES", "20"))  # 一括アップロードの上限枚数
@@ -0,0 +1,139 @@
+import hashlib
+import io
+import json
+import os
+
+import numpy as np
+
+from preprocessing import load_pixels, normalize_pixels, FEATURE_SIZE
+
+MATRIX_FILENAME = 'pixels.npy'
+INDEX_FILENAME = 'index.json'
+MIN_CAPACITY = 256
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_and_decode(path):
+    # プロセスプール内で実行する。ファイルは1回だけ読み、ハッシュとデコードの両方に使う
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+        return path, hashlib.sha256(data).hexdigest(), load_pixels(io.BytesIO(data))
+    except Exception as e:
+        return path, None, e
+
+
+class FeatureStore:
+    """画像ごとの128x128x3画素をメモリマップした行列に保存し、
+    パス・サイズ・更新日時・内容ハッシュの索引で再利用する。
+
+    画素は正規化前の uint8 で保持するため、読み出し時の正規化で
+    推論時と完全に同じ float32 の特徴量になる。"""
+
+    def __init__(self, directory, feature_size=FEATURE_SIZE):
+        self.directory = directory
+        self.feature_size = feature_size
+        self.matrix_path = os.path.join(directory, MATRIX_FILENAME)
+        self.index_path = os.path.join(directory, INDEX_FILENAME)
+        self.entries = {}
+        self.rows = 0
+        self.matrix = None
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        if not (os.path.exists(self.index_path) and os.path.exists(self.matrix_path)):
+            return
+        with open(self.index_path) as f:
+            index = json.load(f)
+        if index.get('feature_size') != self.feature_size:
+            # 特徴量の形が変わった場合は作り直す
+            return
+        self.entries = index['entries']
+        self.rows = index['rows']
+        self.matrix = np.load(self.matrix_path, mmap_mode='r+')
+
+    def save(self):
+        if self.matrix is not None:
+            self.matrix.flush()
+        tmp = f'{self.index_path}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'feature_size': self.feature_size, 'rows': self.rows, 'entries': self.entries}, f)
+        os.replace(tmp, self.index_path)
+
+    def lookup(self, path):
+        # キャッシュが有効なら行番号を返す。新規・変更ありなら None
+        entry = self.entries.get(os.path.realpath(path))
+        if entry is None:
+            return None
+        stat = os.stat(path)
+        if entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+            return entry['row']
+        if entry['size'] == stat.st_size and entry['sha256'] == file_digest(path):
+            # 更新日時だけ変わった（コピーやtouch）場合はデコードせずに再利用する
+            entry['mtime_ns'] = stat.st_mtime_ns
+            return entry['row']
+        return None
+
+    def _ensure_capacity(self, rows):
+        capacity = 0 if self.matrix is None else self.matrix.shape[0]
+        if rows <= capacity:
+            return
+        capacity = max(rows, capacity * 2, MIN_CAPACITY)
+        tmp = f'{self.matrix_path}.tmp'
+        matrix = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.uint8,
+                                           shape=(capacity, self.feature_size))
+        if self.matrix is not None:
+            matrix[:self.rows] = self.matrix[:self.rows]
+        matrix.flush()
+        del matrix
+        self.matrix = None
+        os.replace(tmp, self.matrix_path)
+        self.matrix = np.load(self.matrix_path, mmap_mode='r+')
+
+    def put(self, path, digest, pixels):
+        key = os.path.realpath(path)
+        entry = self.entries.get(key)
+        if entry is None:
+            self._ensure_capacity(self.rows + 1)
+            entry = {'row': self.rows}
+            self.rows += 1
+        stat = os.stat(path)
+        entry.update(size=stat.st_size, mtime_ns=stat.st_mtime_ns, sha256=digest)
+        self.matrix[entry['row']] = pixels
+        self.entries[key] = entry
+        return entry['row']
+
+    def sync(self, paths, executor=None):
+        # 新規・変更された画像だけをデコードし、paths の順に行番号を返す
+        rows = {}
+        missing = []
+        for path in paths:
+            row = self.lookup(path)
+            if row is None:
+                missing.append(path)
+            else:
+                rows[path] = row
+
+        failed = []
+        decoded = executor.map(read_and_decode, missing, chunksize=4) if executor else map(read_and_decode, missing)
+        for path, digest, pixels in decoded:
+            if isinstance(pixels, Exception):
+                failed.append((path, pixels))
+                continue
+            rows[path] = self.put(path, digest, pixels)
+        self.save()
+        return [rows[path] for path in paths if path in rows], missing, failed
+
+    def read(self, rows, out=None, extractor=None):
+        # 指定した行を float32 の特徴量行列として返す。extractor を省略すると正規化した画素
+        if extractor is None:
+            return normalize_pixels(self.matrix[rows], out=out)
+        return extractor.from_pixels(self.matrix[rows], out=out)
@@ -0,0 +1,98 @@
+import cv2
+import numpy as np
+
+from preprocessing import IMAGE_SIZE, FEATURE_SIZE, normalize_pixels, resize_pixels
+
+# 学習したモデルに記録がない場合（以前のモデル）は画素そのものを使う
+DEFAULT_FEATURE_MODE = 'pixels'
+
+
+class PixelFeatures:
+    """128x128x3の画素を0〜1に正規化してそのまま特徴量にする。"""
+
+    mode = 'pixels'
+    size = FEATURE_SIZE
+
+    def from_image(self, image, out=None):
+        # image はデコード済みのBGR画像（大きさは問わない）
+        return self.from_pixels(resize_pixels(image), out=out)
+
+    def from_pixels(self, pixels, out=None):
+        # pixels はリサイズ済みの uint8 画素（1枚なら1次元、N枚なら (N, FEATURE_SIZE)）
+        return normalize_pixels(pixels, out=out)
+
+
+class ColorFeatures:
+    """尿が写っている領域を推定し、その色のヒストグラムと統計量を特徴量にする。
+
+    構図や背景ではなく色だけを見るため、次元数は数十で済み、PCAなしでも学習できる。"""
+
+    mode = 'color'
+    hue_bins = 18
+    saturation_bins = 8
+    value_bins = 8
+    # 色の付いた画素がこの割合より少なければ、画像の中央を対象領域とする
+    min_region_fraction = 0.05
+    size = hue_bins + saturation_bins + value_bins + 2 + 3 + 3 + 1
+
+    def from_image(self, image, out=None):
+        pixels = cv2.resize(image, IMAGE_SIZE, interpolation=cv2.INTER_AREA)
+        return self._extract(pixels, out)
+
+    def from_pixels(self, pixels, out=None):
+        if pixels.ndim == 1:
+            return self._extract(pixels.reshape(IMAGE_SIZE[1], IMAGE_SIZE[0], 3), out)
+        if out is None:
+            out = np.empty((len(pixels), self.size), dtype=np.float32)
+        for row, image_pixels in enumerate(pixels):
+            self._extract(image_pixels.reshape(IMAGE_SIZE[1], IMAGE_SIZE[0], 3), out[row])
+        return out
+
+    def _region(self, hsv):
+        # 白い便器や鏡面反射（彩度が低い・明るすぎる）と暗い影を除いた画素を尿の領域とみなす
+        saturation = hsv[..., 1]
+        value = hsv[..., 2]
+        mask = (saturation >= 20) & (value >= 40) & (value <= 245)
+        if mask.mean() >= self.min_region_fraction:
+            return mask
+        height, width = mask.shape
+        mask = np.zeros_like(mask)
+        mask[height // 4:height * 3 // 4, width // 4:width * 3 // 4] = True
+        return mask
+
+    def _extract(self, pixels, out=None):
+        if out is None:
+            out = np.empty(self.size, dtype=np.float32)
+        hsv = cv2.cvtColor(pixels, cv2.COLOR_BGR2HSV)
+        mask = self._region(hsv)
+        region_hsv = hsv[mask].astype(np.float32)
+        region_lab = cv2.cvtColor(pixels, cv2.COLOR_BGR2LAB)[mask].astype(np.float32) / 255.0
+        n = len(region_hsv)
+
+        offset = 0
+        # OpenCVの色相は0〜179
+        for channel, bins, upper in ((0, self.hue_bins, 180), (1, self.saturation_bins, 256),
+                                     (2, self.value_bins, 256)):
+            histogram, _ = np.histogram(region_hsv[:, channel], bins=bins, range=(0, upper))
+            out[offset:offset + bins] = histogram / n
+            offset += bins
+
+        # 色相は円環なので、平均は角度のベクトルで表す
+        angle = region_hsv[:, 0] * (np.pi / 90.0)
+        out[offset] = np.cos(angle).mean()
+        out[offset + 1] = np.sin(angle).mean()
+        offset += 2
+        out[offset:offset + 3] = region_lab.mean(axis=0)
+        out[offset + 3:offset + 6] = region_lab.std(axis=0)
+        out[offset + 6] = n / mask.size
+        return out
+
+
+FEATURE_EXTRACTORS = {extractor.mode: extractor for extractor in (PixelFeatures(), ColorFeatures())}
+
+
+def get_extractor(mode=None):
+    try:
+        return FEATURE_EXTRACTORS[mode or DEFAULT_FEATURE_MODE]
+    except KeyError:
+        raise ValueError(f'未対応の特徴量です: {mode}') from None
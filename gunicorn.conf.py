@@ -0,0 +1,21 @@
+import os
+import shutil
+import tempfile
+
+# Procfile のコマンドライン引数と合わせて読み込まれる gunicorn の設定
+
+# /metrics で全ワーカーの値を合算するため、prometheus_client をマルチプロセスモードにする。
+# アプリより先にこのファイルが読み込まれるので、ここで環境変数を設定しておく
+prometheus_multiproc_dir = os.environ.setdefault(
+    'PROMETHEUS_MULTIPROC_DIR', os.path.join(tempfile.gettempdir(), 'urouro_prometheus'))
+
+# --preload では on_starting より先にアプリ（metrics）が読み込まれ、ラベルなしのメトリクスは
+# その時点でこのディレクトリにファイルを作るため、ここで作り直しておく。
+# 前回起動時のファイルが残っていると値が合算されてしまうので、中身は消す
+shutil.rmtree(prometheus_multiproc_dir, ignore_errors=True)
+os.makedirs(prometheus_multiproc_dir, exist_ok=True)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
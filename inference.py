@@ -0,0 +1,24 @@
+from metrics import timed, PREDICTIONS
+
+STATUS_NORMAL = "正常"
+STATUS_ABNORMAL = "異常"
+
+
+def predict_statuses(model, vectors):
+    # N枚分を (N, 特徴量数) の行列にまとめ、transform/predictを1回ずつで判定する
+    import numpy as np
+    X = np.asarray(vectors)
+    if X.ndim == 1:
+        X = X[np.newaxis, :]
+    if X.shape[1] != model.features.size:
+        # 推論の直前にモデルが別の特徴量のものへ差し替わった場合
+        raise ValueError(f'特徴量の次元数がモデルと一致しません: {X.shape[1]} != {model.features.size}')
+    if model.pca is not None:
+        with timed('transform'):
+            X = model.pca.transform(X)
+    with timed('predict'):
+        predictions = model.iso_forest.predict(X)
+    statuses = [STATUS_NORMAL if prediction == 1 else STATUS_ABNORMAL for prediction in predictions]
+    for status in statuses:
+        PREDICTIONS.labels(status).inc()
+    return statuses
@@ -0,0 +1,163 @@
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+from inference import predict_statuses
+from metrics import BATCH_SIZE, QUEUE_WAIT
+
+# バッチサイズのヒストグラムの区切り
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+
+
+class InferenceDispatcher:
+    """同じワーカー内の同時リクエストから届いた画像ベクトルを一定時間まとめ、
+    1回のtransform/predictで判定して各リクエストに結果を返す。"""
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self.window = 0.005
+        self.max_batch_size = 32
+        self.logger = None
+        self._queue = queue.Queue()
+        self._thread = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._reset_stats()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config['INFERENCE_BATCHING']
+        self.window = app.config['INFERENCE_BATCH_WINDOW_MS'] / 1000.0
+        self.max_batch_size = app.config['INFERENCE_MAX_BATCH_SIZE']
+        self.logger = app.logger
+        app.extensions['inference_dispatcher'] = self
+
+    def predict(self, vector, model):
+        # vector は model.features で作った特徴量。同じ model で判定し、(ステータス, モデルのバージョン) を返す。
+        # 途中でモデルが再読み込みされても、リクエストは特徴量を作ったときのスナップショットを使い続ける
+        if not self.enabled:
+            return predict_statuses(model, vector)[0], model.version
+
+        self._ensure_worker()
+        future = Future()
+        self._queue.put((vector, model, time.monotonic(), future))
+        return future.result()
+
+    def stats(self):
+        with self._stats_lock:
+            waits = sorted(self._recent_waits)
+            return {
+                'enabled': self.enabled,
+                'window_ms': self.window * 1000.0,
+                'max_batch_size': self.max_batch_size,
+                'batches': self._batches,
+                'requests': self._requests,
+                'errors': self._errors,
+                'queue_depth': self._queue.qsize(),
+                'mean_batch_size': self._requests / self._batches if self._batches else 0.0,
+                'batch_size_histogram': dict(self._batch_size_histogram),
+                'queue_wait_ms': {
+                    'p50': _percentile(waits, 50) * 1000.0,
+                    'p95': _percentile(waits, 95) * 1000.0,
+                    'p99': _percentile(waits, 99) * 1000.0,
+                    'max': (waits[-1] if waits else 0.0) * 1000.0,
+                },
+            }
+
+    def _reset_stats(self):
+        self._batches = 0
+        self._requests = 0
+        self._errors = 0
+        # 各区間に入ったバッチの件数
+        self._batch_size_histogram = {f'<={bound}': 0 for bound in BATCH_SIZE_BUCKETS}
+        self._batch_size_histogram[f'>{BATCH_SIZE_BUCKETS[-1]}'] = 0
+        self._recent_waits = deque(maxlen=1000)
+
+    def _ensure_worker(self):
+        # fork後の子プロセスではスレッドが引き継がれないため、プロセスごとに起動する
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._queue = queue.Queue()
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='inference-dispatcher', daemon=True)
+            self._thread.start()
+
+    def _collect_batch(self):
+        batch = [self._queue.get()]
+        deadline = batch[0][2] + self.window
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    batch.append(self._queue.get(timeout=remaining))
+                else:
+                    # 待ち時間を過ぎても、すでに溜まっている分はまとめて処理する
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect_batch()
+            started = time.monotonic()
+            # 再読み込みをまたいで届いたリクエストは、モデルのバージョンごとに分けて判定する
+            groups = {}
+            for item in batch:
+                groups.setdefault(item[1].version, []).append(item)
+            for group in groups.values():
+                self._predict_group(group, started)
+
+    def _predict_group(self, batch, started):
+        import numpy as np
+        model = batch[0][1]
+        try:
+            statuses = predict_statuses(model, np.stack([vector for vector, _, _, _ in batch]))
+        except Exception as e:
+            self._record(batch, started, failed=True)
+            if self.logger is not None:
+                self.logger.error(f'バッチ推論中のエラー: {e}')
+            for _, _, _, future in batch:
+                future.set_exception(e)
+            return
+
+        self._record(batch, started)
+        for (_, _, _, future), status in zip(batch, statuses):
+            future.set_result((status, model.version))
+
+    def _record(self, batch, started, failed=False):
+        size = len(batch)
+        with self._stats_lock:
+            self._batches += 1
+            self._requests += size
+            if failed:
+                self._errors += 1
+            for bound in BATCH_SIZE_BUCKETS:
+                if size <= bound:
+                    self._batch_size_histogram[f'<={bound}'] += 1
+                    break
+            else:
+                self._batch_size_histogram[f'>{BATCH_SIZE_BUCKETS[-1]}'] += 1
+            for _, _, enqueued, _ in batch:
+                self._recent_waits.append(started - enqueued)
+        BATCH_SIZE.observe(size)
+        for _, _, enqueued, _ in batch:
+            QUEUE_WAIT.observe(started - enqueued)
+
+
+def _percentile(sorted_values, percent):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * percent / 100))
+    return sorted_values[index]
+
+
+inference_dispatcher = InferenceDispatcher()
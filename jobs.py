@@ -0,0 +1,170 @@
+import io
+import multiprocessing
+import os
+import threading
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+
+from models import db, Result, InferenceJob, now_jst
+from model_registry import ModelRegistry
+from inference import predict_statuses
+from rollups import record_results
+from metrics import record_error
+
+JOB_QUEUED = 'queued'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+
+# ワーカープロセス内で使うモデル（プロセスごとに一度だけ読み込む）
+_worker_registry = None
+
+
+def _init_worker(engine, pca_path, iso_forest_path, compiled_path, manifest_path, reload_interval):
+    global _worker_registry
+    _worker_registry = ModelRegistry()
+    _worker_registry.engine = engine
+    _worker_registry.pca_path = pca_path
+    _worker_registry.iso_forest_path = iso_forest_path
+    _worker_registry.compiled_path = compiled_path
+    _worker_registry.manifest_path = manifest_path
+    _worker_registry.reload_interval = reload_interval
+
+
+def _score(data):
+    # ワーカープロセスで前処理と推論を行い、(ステータス, モデルのバージョン) を返す
+    from preprocessing import decode_image
+    model = _worker_registry.get()
+    vector = model.features.from_image(decode_image(io.BytesIO(data)))
+    return predict_statuses(model, vector)[0], model.version
+
+
+class JobRunner:
+    """アップロードをジョブとしてDBに記録し、ローカルのプロセスプールで推論する。
+    待ち件数が上限に達したら受け付けず、呼び出し側で503を返す。"""
+
+    def __init__(self, app=None):
+        self.app = None
+        self.max_workers = 2
+        self.max_pending = 16
+        self.timeout = 120
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._pending = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.max_workers = app.config['JOB_WORKERS']
+        self.max_pending = app.config['JOB_QUEUE_LIMIT']
+        self.timeout = app.config['JOB_TIMEOUT']
+        app.extensions['job_runner'] = self
+
+    def create(self, user_id, image_id):
+        job = InferenceJob(id=uuid.uuid4().hex, status=JOB_QUEUED, user_id=user_id, image_id=image_id)
+        db.session.add(job)
+        return job
+
+    def has_capacity(self):
+        return self._pending < self.max_pending
+
+    def submit(self, job_id, data, on_result=None):
+        # 待ち件数が上限に達しているか、プールを作り直しても受け付けられなければ False を返す
+        executor = self._get_executor()
+        with self._lock:
+            if self._pending >= self.max_pending:
+                return False
+            self._pending += 1
+        for _ in range(2):
+            try:
+                future = executor.submit(_score, data)
+                break
+            except BrokenProcessPool as e:
+                # 子プロセスが異常終了（メモリ不足など）したプールは以後使えないので作り直す
+                self._discard_executor(executor, e)
+                executor = self._get_executor()
+            except Exception:
+                self._release()
+                raise
+        else:
+            self._release()
+            return False
+        future.add_done_callback(lambda f: self._finish(job_id, executor, f, on_result))
+        return True
+
+    def pending(self):
+        return self._pending
+
+    def expire_stale(self, job):
+        # ワーカーの再起動などで取り残されたジョブは一定時間後に失敗とする
+        if job.status == JOB_QUEUED and (datetime.utcnow() - job.created_at).total_seconds() > self.timeout:
+            job.status = JOB_FAILED
+            job.error = 'timeout'
+            job.finished_at = datetime.utcnow()
+            db.session.commit()
+
+    def _get_executor(self):
+        # fork後の子プロセスではプールを引き継げないため、プロセスごとに作り直す
+        if self._executor is None or self._pid != os.getpid():
+            with self._lock:
+                if self._executor is None or self._pid != os.getpid():
+                    config = self.app.config
+                    self._executor = ProcessPoolExecutor(
+                        max_workers=self.max_workers,
+                        mp_context=multiprocessing.get_context('spawn'),
+                        initializer=_init_worker,
+                        initargs=(config['MODEL_ENGINE'], config['PCA_MODEL_PATH'],
+                                  config['ISO_FOREST_MODEL_PATH'], config['COMPILED_MODEL_PATH'],
+                                  config['MODEL_MANIFEST_PATH'], config['MODEL_RELOAD_INTERVAL']))
+                    if self._pid != os.getpid():
+                        self._pending = 0
+                    self._pid = os.getpid()
+        return self._executor
+
+    def _discard_executor(self, executor, error):
+        with self._lock:
+            if self._executor is not executor:
+                return
+            self._executor = None
+        self.app.logger.error(f'推論プールが使えなくなったため作り直します: {error}')
+        executor.shutdown(wait=False)
+
+    def _release(self):
+        with self._lock:
+            self._pending -= 1
+
+    def _finish(self, job_id, executor, future, on_result):
+        try:
+            with self.app.app_context():
+                job = db.session.get(InferenceJob, job_id)
+                try:
+                    status, model_version = future.result()
+                except Exception as e:
+                    if isinstance(e, BrokenProcessPool):
+                        self._discard_executor(executor, e)
+                    record_error(e)
+                    self.app.logger.error(f'ジョブの処理中のエラー: {job_id}: {e}')
+                    job.status = JOB_FAILED
+                    job.error = str(e)[:200]
+                else:
+                    result = Result(status=status, user_id=job.user_id, date=now_jst(),
+                                    model_version=model_version, image_id=job.image_id)
+                    db.session.add(result)
+                    record_results([result])
+                    job.result = result
+                    job.status = JOB_DONE
+                    if on_result is not None:
+                        on_result(model_version, status)
+                job.finished_at = datetime.utcnow()
+                db.session.commit()
+                self.app.logger.info(f'ジョブが完了しました: {job_id} ({job.status})')
+        except Exception as e:
+            self.app.logger.error(f'ジョブの結果を保存できませんでした: {job_id}: {e}')
+        finally:
+            self._release()
+
+
+job_runner = JobRunner()
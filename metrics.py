@@ -0,0 +1,65 @@
+import os
+import time
+from contextlib import contextmanager
+
+from flask import request, g
+from prometheus_client import (CollectorRegistry, Counter, Histogram, REGISTRY, CONTENT_TYPE_LATEST,
+                               generate_latest, multiprocess)
+
+# gunicornの複数ワーカーの値を集約するため、PROMETHEUS_MULTIPROC_DIR が設定されていれば
+# prometheus_client はプロセスごとのファイルに書き込み、/metrics で合算する
+
+REQUEST_LATENCY = Histogram(
+    'urouro_http_request_duration_seconds', 'HTTPリクエストの処理時間',
+    ['method', 'endpoint', 'status'])
+STAGE_LATENCY = Histogram(
+    'urouro_upload_stage_duration_seconds', 'アップロード処理の段階ごとの処理時間',
+    ['stage'], buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0))
+UPLOADS = Counter('urouro_uploads_total', '受け付けた画像の枚数', ['endpoint'])
+UPLOAD_ERRORS = Counter('urouro_upload_errors_total', '画像処理中のエラー', ['exception'])
+PREDICTIONS = Counter('urouro_predictions_total', '判定結果の件数', ['status'])
+PREDICTION_CACHE = Counter('urouro_prediction_cache_total', '判定結果キャッシュの参照結果', ['result'])
+BATCH_SIZE = Histogram(
+    'urouro_inference_batch_size', 'まとめて推論したリクエスト数',
+    buckets=(1, 2, 4, 8, 16, 32, 64))
+QUEUE_WAIT = Histogram(
+    'urouro_inference_queue_wait_seconds', '推論キューでの待ち時間',
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0))
+
+
+@contextmanager
+def timed(stage):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_LATENCY.labels(stage).observe(time.perf_counter() - started)
+
+
+def record_error(error):
+    UPLOAD_ERRORS.labels(type(error).__name__).inc()
+
+
+def export():
+    # (本文, Content-Type) を返す
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def init_app(app):
+    @app.before_request
+    def start_timer():
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def observe_request(response):
+        started = g.pop('request_started', None)
+        if started is not None:
+            # ラベルの種類が増えすぎないよう、URLではなくエンドポイント名で集計する
+            REQUEST_LATENCY.labels(request.method, request.endpoint or 'unmatched',
+                                   response.status_code).observe(time.perf_counter() - started)
+        return response
@@ -0,0 +1,25 @@
+"""Add (user_id, id DESC) index to Result
+
+Revision ID: 3c7a1e5f9b20
+Revises: 9d4e2c7b1a58
+Create Date: 2026-10-17 09:21:44.603187
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3c7a1e5f9b20'
+down_revision = '9d4e2c7b1a58'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # ページのバージョン（ユーザーの最後に追加された結果のid）をインデックスの1回の参照で求める
+    op.create_index('ix_result_user_id_id', 'result', ['user_id', sa.text('id DESC')], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_result_user_id_id', table_name='result')
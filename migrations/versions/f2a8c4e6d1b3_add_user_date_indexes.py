@@ -0,0 +1,29 @@
+"""Add (user_id, date DESC) indexes to Result and Image
+
+Revision ID: f2a8c4e6d1b3
+Revises: e5d03a7c1b62
+Create Date: 2026-10-16 17:48:36.205114
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f2a8c4e6d1b3'
+down_revision = 'e5d03a7c1b62'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # 最新の結果の取得と履歴のキーセットページングでソートを不要にする
+    op.create_index('ix_result_user_id_date', 'result',
+                    ['user_id', sa.text('date DESC'), sa.text('id DESC')], unique=False)
+    op.create_index('ix_image_user_id_date', 'image',
+                    ['user_id', sa.text('date DESC'), sa.text('id DESC')], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_image_user_id_date', table_name='image')
+    op.drop_index('ix_result_user_id_date', table_name='result')
@@ -1,37 +1,251 @@
-import numpy as np
-import cv2
+import argparse
+import json
 import os
-from sklearn.decomposition import PCA
-from sklearn.ensemble import IsolationForest
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from functools import partial
+
 import joblib
+import numpy as np
+from sklearn.decomposition import PCA, IncrementalPCA
+from sklearn.ensemble import IsolationForest
+
+from feature_store import FeatureStore
+from numpy_engine import export_model
+from model_registry import publish_manifest
+from features import FEATURE_EXTRACTORS, DEFAULT_FEATURE_MODE, get_extractor
+from preprocessing import decode_image
+
+# 学習に使う画像の拡張子（大文字小文字は区別しない）
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp'}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='正常データからPCAとIsolation Forestを学習する')
+    parser.add_argument('--data-dir', default='dataset/normal', help='正常データのディレクトリ')
+    parser.add_argument('--output-dir', default='models', help='バージョンごとの成果物を保存するディレクトリ')
+    parser.add_argument('--manifest-path', default=os.getenv('MODEL_MANIFEST_PATH', 'model_manifest.json'),
+                        help='サーバーが読み込むモデル一式を指すマニフェストのパス')
+    parser.add_argument('--no-publish', action='store_true', help='サーバー用のマニフェストへ反映しない')
+    parser.add_argument('--solver', choices=['incremental', 'randomized'], default='incremental',
+                        help='incremental: チャンクごとに逐次学習 / randomized: 全件を読み込みランダム化SVD')
+    parser.add_argument('--features', choices=sorted(FEATURE_EXTRACTORS), default=DEFAULT_FEATURE_MODE,
+                        help='pixels: 128x128の画素 / color: 尿の領域の色ヒストグラムと統計量')
+    parser.add_argument('--no-pca', action='store_true',
+                        help='PCAを使わず特徴量をそのままIsolation Forestに渡す（colorで推奨）')
+    parser.add_argument('--n-components', type=int, default=50)
+    parser.add_argument('--chunk-size', type=int, default=256, help='IncrementalPCAに渡す1チャンクの画像数')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='デコードに使うプロセス数')
+    parser.add_argument('--contamination', type=float, default=0.1)
+    parser.add_argument('--cache-dir', default='feature_cache', help='デコード済み画素のキャッシュ先')
+    parser.add_argument('--no-cache', action='store_true', help='キャッシュを使わず毎回デコードする')
+    return parser.parse_args()
+
+
+def list_images(data_dir):
+    paths = []
+    for filename in sorted(os.listdir(data_dir)):
+        if os.path.splitext(filename)[1].lower() in IMAGE_EXTENSIONS:
+            paths.append(os.path.join(data_dir, filename))
+    return paths
+
+
+def decode(extractor, path):
+    # プロセスプール内で実行する。読み込めない画像は例外を返して学習から除外する
+    try:
+        return path, extractor.from_image(decode_image(path))
+    except Exception as e:
+        return path, e
+
+
+class DecodeStats:
+    def __init__(self):
+        self.images = 0
+        self.failed = []
+        self.seconds = 0.0
+
+    def throughput(self):
+        return self.images / self.seconds if self.seconds else 0.0
+
+
+def iter_chunks(executor, extractor, paths, chunk_size, stats):
+    # デコード済みの画像をチャンク単位の float32 行列として順に返す
+    started = time.perf_counter()
+    buffer = np.empty((chunk_size, extractor.size), dtype=np.float32)
+    filled = 0
+    for path, vector in executor.map(partial(decode, extractor), paths, chunksize=4):
+        if isinstance(vector, Exception):
+            print(f'読み込みに失敗したためスキップします: {path}: {vector}')
+            stats.failed.append(path)
+            continue
+        buffer[filled] = vector
+        filled += 1
+        stats.images += 1
+        if filled == chunk_size:
+            stats.seconds += time.perf_counter() - started
+            yield buffer
+            started = time.perf_counter()
+            filled = 0
+    stats.seconds += time.perf_counter() - started
+    if filled:
+        yield buffer[:filled]
+
+
+def iter_cached_chunks(store, extractor, rows, chunk_size, stats):
+    # キャッシュ済みの画素をメモリマップから読み出し、チャンクごとに特徴量にして返す
+    buffer = np.empty((chunk_size, extractor.size), dtype=np.float32)
+    for start in range(0, len(rows), chunk_size):
+        started = time.perf_counter()
+        chunk_rows = rows[start:start + chunk_size]
+        chunk = store.read(chunk_rows, out=buffer[:len(chunk_rows)], extractor=extractor)
+        stats.images += len(chunk_rows)
+        stats.seconds += time.perf_counter() - started
+        yield chunk
+
+
+def iter_fit_chunks(chunks, min_size):
+    # IncrementalPCAは各チャンクに n_components 件以上必要なので、
+    # 端数の最終チャンクは直前のチャンクと結合して渡す
+    previous = None
+    for chunk in chunks:
+        if previous is not None:
+            if len(chunk) < min_size:
+                yield np.concatenate([previous, chunk])
+                return
+            yield previous
+        previous = chunk.copy()
+    if previous is not None:
+        yield previous
+
+
+def fit_incremental(chunks, n_images, feature_size, args):
+    n_components = min(args.n_components, n_images, feature_size)
+    chunk_size = max(args.chunk_size, n_components)
+    pca = IncrementalPCA(n_components=n_components)
+
+    # 1パス目: チャンクごとにPCAを更新する
+    fit_stats = DecodeStats()
+    fit_started = time.perf_counter()
+    for chunk in iter_fit_chunks(chunks(chunk_size, fit_stats), n_components):
+        pca.partial_fit(chunk)
+    fit_seconds = time.perf_counter() - fit_started - fit_stats.seconds
+    print(f'PCA学習: {fit_stats.images}枚 読み込み {fit_stats.throughput():.1f}枚/秒, 学習 {fit_seconds:.1f}秒')
+
+    # 2パス目: 学習済みPCAで全件を射影する（メモリに載せるのは射影後の低次元データのみ）
+    transform_stats = DecodeStats()
+    data_pca = np.concatenate([
+        pca.transform(chunk)
+        for chunk in chunks(chunk_size, transform_stats)
+    ])
+    print(f'PCA射影: {transform_stats.images}枚 読み込み {transform_stats.throughput():.1f}枚/秒')
+    return pca, data_pca, fit_stats, fit_seconds
+
+
+def load_all(chunks, n_images, feature_size, args):
+    stats = DecodeStats()
+    data = np.empty((n_images, feature_size), dtype=np.float32)
+    for chunk in chunks(args.chunk_size, stats):
+        data[stats.images - len(chunk):stats.images] = chunk
+    return data[:stats.images], stats
+
+
+def fit_randomized(chunks, n_images, feature_size, args):
+    data, stats = load_all(chunks, n_images, feature_size, args)
+
+    fit_started = time.perf_counter()
+    n_components = min(args.n_components, len(data), feature_size)  # 次元数はデータ数・特徴量数以下
+    pca = PCA(n_components=n_components, svd_solver='randomized')
+    data_pca = pca.fit_transform(data)
+    fit_seconds = time.perf_counter() - fit_started
+    print(f'PCA学習: {stats.images}枚 読み込み {stats.throughput():.1f}枚/秒, 学習 {fit_seconds:.1f}秒')
+    return pca, data_pca, stats, fit_seconds
+
+
+def main():
+    args = parse_args()
+    paths = list_images(args.data_dir)
+    if not paths:
+        raise SystemExit(f'画像が見つかりません: {args.data_dir}')
+    extractor = get_extractor(args.features)
+    solver = 'none' if args.no_pca else args.solver
+    print(f'{len(paths)}枚の画像で学習します (features={extractor.mode}, {extractor.size}次元, '
+          f'solver={solver}, workers={args.workers})')
+
+    skipped = []
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        if args.no_cache:
+            n_images = len(paths)
+            chunks = partial(iter_chunks, executor, extractor, paths)
+        else:
+            # 新規・変更された画像だけをデコードし、残りはキャッシュから読む
+            sync_started = time.perf_counter()
+            store = FeatureStore(args.cache_dir)
+            rows, decoded, failed = store.sync(paths, executor)
+            for path, error in failed:
+                print(f'読み込みに失敗したためスキップします: {path}: {error}')
+                skipped.append(path)
+            print(f'特徴量キャッシュ: {len(paths) - len(decoded)}枚を再利用, {len(decoded)}枚をデコード '
+                  f'({time.perf_counter() - sync_started:.1f}秒)')
+            n_images = len(rows)
+            chunks = partial(iter_cached_chunks, store, extractor, rows)
 
-# 正常データのディレクトリ
-normal_dir = 'dataset/normal'
+        if args.no_pca:
+            # 色特徴量は数十次元なので、全件をそのまま読み込んでも小さい
+            pca, pca_seconds = None, 0.0
+            data_pca, decode_stats = load_all(chunks, n_images, extractor.size, args)
+            print(f'特徴量: {decode_stats.images}枚 読み込み {decode_stats.throughput():.1f}枚/秒')
+        elif args.solver == 'incremental':
+            pca, data_pca, decode_stats, pca_seconds = fit_incremental(chunks, n_images, extractor.size, args)
+        else:
+            pca, data_pca, decode_stats, pca_seconds = fit_randomized(chunks, n_images, extractor.size, args)
 
-# データリスト
-data = []
+    # Isolation Forestによる異常検知モデルの学習
+    forest_started = time.perf_counter()
+    iso_forest = IsolationForest(contamination=args.contamination)
+    iso_forest.fit(data_pca)
+    # サーバーは推論時にこの値を見て学習時と同じ特徴量を作る
+    iso_forest.feature_mode = extractor.mode
+    forest_seconds = time.perf_counter() - forest_started
+    print(f'Isolation Forest学習: {forest_seconds:.1f}秒')
 
-# 正常データの読み込み
-for filename in os.listdir(normal_dir):
-    if filename.endswith(".jpg") or filename.endswith(".png"):
-        image_path = os.path.join(normal_dir, filename)
-        image = cv2.imread(image_path)
-        image = cv2.resize(image, (128, 128))
-        image = image.flatten() / 255.0
-        data.append(image)
+    # モデルの保存（バージョンごとのディレクトリに保存してからサーバー用のパスへ反映）
+    # PCAを使わない場合も、サーバーが同じ2ファイルを監視できるよう None を保存する
+    version = datetime.now().strftime('%Y%m%d%H%M%S')
+    version_dir = os.path.join(args.output_dir, version)
+    os.makedirs(version_dir, exist_ok=True)
+    pca_path = os.path.join(version_dir, 'pca_model.pkl')
+    iso_forest_path = os.path.join(version_dir, 'iso_forest_model.pkl')
+    joblib.dump(pca, pca_path)
+    joblib.dump(iso_forest, iso_forest_path)
+    # scikit-learnなしで推論できるよう、同じモデルを配列にして書き出す
+    compiled_path = os.path.join(version_dir, 'model.npz')
+    export_model(compiled_path, pca, iso_forest, extractor.mode)
 
-# NumPy配列に変換
-data = np.array(data)
+    metadata = {
+        'version': version,
+        'created_at': datetime.now().isoformat(),
+        'data_dir': args.data_dir,
+        'n_images': decode_stats.images,
+        'skipped': skipped + decode_stats.failed,
+        'features': extractor.mode,
+        'feature_size': extractor.size,
+        'solver': solver,
+        'n_components': int(pca.n_components_) if pca is not None else None,
+        'contamination': args.contamination,
+        'decode_images_per_second': decode_stats.throughput(),
+        'pca_fit_seconds': pca_seconds,
+        'iso_forest_fit_seconds': forest_seconds,
+    }
+    with open(os.path.join(version_dir, 'metadata.json'), 'w') as f:
+        json.dump(metadata, f, ensure_ascii=False, indent=2)
+    print(f'モデルを保存しました: {version_dir}')
 
-# PCAによる次元削減
-n_components = min(len(data), 50)  # 次元数はデータ数以下
-pca = PCA(n_components=n_components)
-data_pca = pca.fit_transform(data)
+    if not args.no_publish:
+        # サーバーはマニフェストの更新を検知し、記録された組をまとめて読み込み直す
+        publish_manifest(args.manifest_path, pca_path, iso_forest_path, compiled_path, version)
+        print(f'サーバー用のモデルを更新しました: {args.manifest_path} -> {version_dir}')
 
-# Isolation Forestによる異常検知モデルの学習
-iso_forest = IsolationForest(contamination=0.1)
-iso_forest.fit(data_pca)
 
-# モデルの保存
-joblib.dump(pca, 'pca_model.pkl')
-joblib.dump(iso_forest, 'iso_forest_model.pkl')
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime
+
+# sklearn: PCAとIsolation Forestのpickleを読み込む / numpy: 書き出した配列だけで推論する（scikit-learn不要）
+ENGINE_SKLEARN = 'sklearn'
+ENGINE_NUMPY = 'numpy'
+
+# 推論に使うモデル一式（リクエスト中はこのスナップショットを使い続ける）
+# features は学習時と同じ特徴量の抽出器。PCAを使わずに学習したモデルでは pca は None
+ModelBundle = namedtuple('ModelBundle', ['pca', 'iso_forest', 'features', 'version', 'loaded_at'])
+
+# マニフェストに記録するモデルのファイル
+MANIFEST_KEYS = ('pca', 'iso_forest', 'compiled')
+
+
+def read_manifest(path):
+    # マニフェストに記録されたパス（マニフェストのディレクトリからの相対パス）を解決して返す
+    with open(path) as f:
+        manifest = json.load(f)
+    base = os.path.dirname(os.path.abspath(path))
+    return {key: os.path.join(base, manifest[key]) for key in MANIFEST_KEYS}
+
+
+def publish_manifest(path, pca_path, iso_forest_path, compiled_path, version=None):
+    # 学習したモデル一式を指すマニフェストを1回の置き換えで公開する。
+    # PCAとIsolation Forestを別々に置き換えると、その間に読み込んだサーバーが新旧の組み合わせで推論してしまう。
+    # 指す先のファイルはバージョンごとのディレクトリにあり、公開後は書き換えない
+    base = os.path.dirname(os.path.abspath(path))
+    paths = dict(zip(MANIFEST_KEYS, (pca_path, iso_forest_path, compiled_path)))
+    manifest = {key: os.path.relpath(os.path.abspath(value), base) for key, value in paths.items()}
+    manifest.update(version=version, published_at=datetime.now().isoformat())
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+
+
+class ModelRegistry:
+    """PCAとIsolation Forestをプロセスごとに一度だけ読み込み、
+    ファイルの更新を検知したら新しいモデルに差し替える。"""
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._bundle = None
+        self._signature = None
+        self._last_check = 0.0
+        self.pca_path = 'pca_model.pkl'
+        self.iso_forest_path = 'iso_forest_model.pkl'
+        self.engine = ENGINE_SKLEARN
+        self.compiled_path = 'model.npz'
+        self.manifest_path = 'model_manifest.json'
+        self.reload_interval = 5.0
+        self.logger = None
+        self._listeners = []
+        self._file_version = None
+        self._file_version_signature = None
+        self._file_version_checked = 0.0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.pca_path = app.config['PCA_MODEL_PATH']
+        self.iso_forest_path = app.config['ISO_FOREST_MODEL_PATH']
+        self.engine = app.config['MODEL_ENGINE']
+        self.compiled_path = app.config['COMPILED_MODEL_PATH']
+        self.manifest_path = app.config['MODEL_MANIFEST_PATH']
+        self.reload_interval = app.config['MODEL_RELOAD_INTERVAL']
+        self.logger = app.logger
+        app.extensions['model_registry'] = self
+
+    @property
+    def version(self):
+        bundle = self._bundle
+        return bundle.version if bundle else None
+
+    @property
+    def loaded_at(self):
+        bundle = self._bundle
+        return bundle.loaded_at if bundle else None
+
+    def file_version(self):
+        # モデルを読み込まずに、公開中のファイルから決まるバージョン（get() で読み込んだときと同じ値）を返す。
+        # 推論を別プロセスで行う非同期モードのWebプロセスが、判定結果キャッシュを引くのに使う
+        if self._bundle is not None:
+            return self.get().version
+        with self._lock:
+            if time.monotonic() - self._file_version_checked >= self.reload_interval:
+                self._file_version_checked = time.monotonic()
+                try:
+                    paths = self._paths()
+                    signature = self._file_signature(paths)
+                    if signature != self._file_version_signature:
+                        self._file_version = self._content_hash(paths)
+                        self._file_version_signature = signature
+                except Exception as e:
+                    self._log('error', f'モデルのバージョンを確認できませんでした: {e}')
+                    self._file_version = None
+                    self._file_version_signature = None
+            return self._file_version
+
+    def add_listener(self, callback):
+        # モデルのバージョンが切り替わったときに新しい ModelBundle を渡して呼び出す
+        self._listeners.append(callback)
+
+    def get(self):
+        bundle = self._bundle
+        if bundle is None:
+            return self.load()
+        if time.monotonic() - self._last_check >= self.reload_interval:
+            # 他のスレッドが再読み込み中なら待たずに現行モデルを使う
+            if self._lock.acquire(blocking=False):
+                try:
+                    self._reload_if_changed()
+                finally:
+                    self._lock.release()
+        return self._bundle
+
+    def load(self):
+        with self._lock:
+            if self._bundle is None:
+                self._reload_if_changed(force=True)
+            return self._bundle
+
+    def model_paths(self):
+        # 公開中のモデルの (PCA, Isolation Forest, 配列ファイル) のパスを返す。
+        # マニフェストがあれば、個別のパスの設定ではなくそこに記録された組を使う
+        if os.path.exists(self.manifest_path):
+            manifest = read_manifest(self.manifest_path)
+            return tuple(manifest[key] for key in MANIFEST_KEYS)
+        return self.pca_path, self.iso_forest_path, self.compiled_path
+
+    def _paths(self):
+        pca_path, iso_forest_path, compiled_path = self.model_paths()
+        if self.engine == ENGINE_NUMPY:
+            return (compiled_path,)
+        return (pca_path, iso_forest_path)
+
+    def _load_models(self, paths):
+        # (PCA, Isolation Forest, 特徴量の種類) を返す
+        if self.engine == ENGINE_NUMPY:
+            from numpy_engine import load_model
+            pca, iso_forest = load_model(paths[0])
+        else:
+            import joblib
+            pca = joblib.load(paths[0])
+            iso_forest = joblib.load(paths[1])
+        # 特徴量の種類は学習時にIsolation Forestへ記録してある
+        return pca, iso_forest, getattr(iso_forest, 'feature_mode', None)
+
+    def _file_signature(self, paths):
+        signature = []
+        for path in paths:
+            stat = os.stat(path)
+            signature.append((path, stat.st_mtime_ns, stat.st_size))
+        return tuple(signature)
+
+    def _content_hash(self, paths):
+        digest = hashlib.sha256()
+        for path in paths:
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(chunk)
+        return digest.hexdigest()[:12]
+
+    def _reload_if_changed(self, force=False):
+        self._last_check = time.monotonic()
+        try:
+            # マニフェストを1度だけ読み、そこに記録された組を1つの単位として読み込む
+            paths = self._paths()
+            signature = self._file_signature(paths)
+            if not force and signature == self._signature:
+                return
+            version = self._content_hash(paths)
+            if not force and self._bundle is not None and version == self._bundle.version:
+                # 更新日時だけが変わった場合は読み込み直さない
+                self._signature = signature
+                return
+            pca, iso_forest, feature_mode = self._load_models(paths)
+            from features import get_extractor
+            features = get_extractor(feature_mode)
+        except Exception as e:
+            # 書き込み途中のファイルなどで失敗した場合は現行モデルを使い続ける
+            if self._bundle is None:
+                raise
+            self._log('error', f'モデルの再読み込みに失敗しました: {e}')
+            return
+
+        # 参照の差し替えは原子的なので、処理中のリクエストは古いモデルのまま完了する
+        previous = self._bundle
+        self._bundle = ModelBundle(pca=pca, iso_forest=iso_forest, features=features,
+                                   version=version, loaded_at=datetime.utcnow())
+        self._signature = signature
+        self._log('info', f'モデルを読み込みました: version={version}, engine={self.engine}, '
+                           f'features={features.mode}')
+        if previous is not None and previous.version != version:
+            for callback in self._listeners:
+                callback(self._bundle)
+
+    def _log(self, level, message):
+        if self.logger is not None:
+            getattr(self.logger, level)(message)
+
+
+model_registry = ModelRegistry()
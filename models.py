@@ -1,9 +1,18 @@
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
 from datetime import datetime
+import pytz
 
 db = SQLAlchemy()
 
+JST = pytz.timezone('Asia/Tokyo')
+
+def now_jst():
+    # 日本のタイムゾーンを使用して現在時刻を取得。
+    # 列はタイムゾーンなしのため、tz付きで渡すとPostgreSQLはセッションのタイムゾーン（通常UTC）に
+    # 変換して保存してしまう。どのDBでも日本時間の時刻がそのまま保存されるよう naive な値で返す
+    return datetime.now(JST).replace(tzinfo=None)
+
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False)
@@ -19,9 +28,48 @@ class Result(db.Model):
     status = db.Column(db.String(20), nullable=False)
     date = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    model_version = db.Column(db.String(32))
+    image_id = db.Column(db.Integer, db.ForeignKey('image.id'), index=True)
+    image = db.relationship('Image', backref='results', lazy=True)
+
+# ユーザーごとの最新の結果・履歴のページングに使う
+db.Index('ix_result_user_id_date', Result.user_id, Result.date.desc(), Result.id.desc())
+# 過去の日付で追加された結果も含め、ユーザーの最後に追加された結果を求める（ページのバージョン）
+db.Index('ix_result_user_id_id', Result.user_id, Result.id.desc())
 
 class Image(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     filename = db.Column(db.String(100), nullable=False)
+    content_hash = db.Column(db.String(64), index=True)
+    storage_path = db.Column(db.String(255))
+    # モデルに入力する128x128の画素（PNG）。原本を再圧縮する前に作る
+    artifact_path = db.Column(db.String(255))
+    compacted_at = db.Column(db.DateTime)  # 原本を再圧縮した日時
     date = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+
+db.Index('ix_image_user_id_date', Image.user_id, Image.date.desc(), Image.id.desc())
+
+class ResultRollup(db.Model):
+    # ユーザー・期間・ステータスごとのResultの件数（Resultの追加と同じトランザクションで更新）
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    period = db.Column(db.String(10), nullable=False)
+    period_start = db.Column(db.Date, nullable=False)
+    status = db.Column(db.String(20), nullable=False)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'period', 'period_start', 'status',
+                            name='uq_result_rollup_user_period_start_status'),
+    )
+
+class InferenceJob(db.Model):
+    id = db.Column(db.String(32), primary_key=True)
+    status = db.Column(db.String(20), nullable=False, default='queued')
+    error = db.Column(db.String(200))
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    image_id = db.Column(db.Integer, db.ForeignKey('image.id'), nullable=False)
+    result_id = db.Column(db.Integer, db.ForeignKey('result.id'))
+    result = db.relationship('Result', lazy=True)
@@ -0,0 +1,194 @@
+import struct
+import zipfile
+
+import numpy as np
+
+# 書き出し形式の版（配列の構成を変えたら上げる）
+FORMAT_VERSION = 1
+TREE_LEAF = -1
+
+
+def average_path_length(n_samples):
+    # n件の二分探索木で探索に失敗するときの平均経路長（scikit-learnの _average_path_length と同じ式）
+    n_samples = np.asarray(n_samples, dtype=np.float64)
+    lengths = np.zeros(n_samples.shape)
+    lengths[n_samples == 2] = 1.0
+    mask = n_samples > 2
+    lengths[mask] = (2.0 * (np.log(n_samples[mask] - 1.0) + np.euler_gamma)
+                     - 2.0 * (n_samples[mask] - 1.0) / n_samples[mask])
+    return lengths
+
+
+def _node_depths(children_left, children_right):
+    # 根を1とした各ノードの深さ。子ノードは必ず親より後の番号に並んでいる
+    depths = np.zeros(len(children_left), dtype=np.float64)
+    depths[0] = 1.0
+    for node in range(len(children_left)):
+        if children_left[node] != TREE_LEAF:
+            depths[children_left[node]] = depths[node] + 1.0
+            depths[children_right[node]] = depths[node] + 1.0
+    return depths
+
+
+def export_model(path, pca, iso_forest, feature_mode):
+    """学習済みのPCAとIsolation Forestを、推論に必要な配列だけの非圧縮 .npz に書き出す。
+
+    木はすべて1つのノード配列に連結し、各木の根の位置を roots に持つ。
+    葉には scikit-learn と同じ「深さ + 平均経路長 - 1」をあらかじめ計算しておく。"""
+    arrays = {
+        'format_version': np.array(FORMAT_VERSION),
+        'feature_mode': np.array(feature_mode),
+        'n_features_in': np.array(pca.n_features_in_ if pca is not None else iso_forest.n_features_in_),
+    }
+    if pca is not None:
+        arrays['pca_components'] = np.ascontiguousarray(pca.components_)
+        # transform では射影後に平均の射影を引く
+        arrays['pca_offset'] = pca.mean_.reshape(1, -1) @ pca.components_.T
+        if pca.whiten:
+            scale = np.sqrt(pca.explained_variance_)
+            scale[scale < np.finfo(scale.dtype).eps] = np.finfo(scale.dtype).eps
+            arrays['pca_scale'] = scale
+
+    n_features = iso_forest.n_features_in_
+    # 特徴量をサンプリングした場合だけ、各木は列を選び直した行列で学習されている
+    subsample_features = getattr(iso_forest, '_max_features', n_features) != n_features
+    lefts, rights, features, thresholds, leaf_values, roots = [], [], [], [], [], []
+    offset = 0
+    max_depth = 0
+    for estimator, estimator_features in zip(iso_forest.estimators_, iso_forest.estimators_features_):
+        tree = estimator.tree_
+        left = tree.children_left.astype(np.int64)
+        right = tree.children_right.astype(np.int64)
+        is_leaf = left == TREE_LEAF
+        feature = np.where(is_leaf, 0, tree.feature)
+        if subsample_features:
+            feature = np.asarray(estimator_features)[feature]
+        depths = _node_depths(left, right)
+
+        roots.append(offset)
+        lefts.append(np.where(is_leaf, TREE_LEAF, left + offset))
+        rights.append(np.where(is_leaf, TREE_LEAF, right + offset))
+        features.append(feature)
+        thresholds.append(tree.threshold)
+        leaf_values.append(depths + average_path_length(tree.n_node_samples) - 1.0)
+        offset += tree.node_count
+        max_depth = max(max_depth, tree.max_depth)
+
+    max_samples = getattr(iso_forest, '_max_samples', iso_forest.max_samples_)
+    arrays.update(
+        children_left=np.concatenate(lefts).astype(np.int32),
+        children_right=np.concatenate(rights).astype(np.int32),
+        feature=np.concatenate(features).astype(np.int32),
+        threshold=np.concatenate(thresholds).astype(np.float64),
+        leaf_value=np.concatenate(leaf_values),
+        roots=np.array(roots, dtype=np.int32),
+        max_depth=np.array(max_depth),
+        denominator=np.array(len(iso_forest.estimators_) * average_path_length(max_samples)),
+        offset=np.array(iso_forest.offset_, dtype=np.float64),
+    )
+    # メモリマップで読めるよう圧縮しない
+    with open(path, 'wb') as f:
+        np.savez(f, **arrays)
+
+
+def load_npz_mmap(path):
+    # 非圧縮の .npz の各配列を、ファイル全体の1つのメモリマップ上のビューとして返す。
+    # 同じファイルを読む複数のワーカーはページキャッシュを共有する
+    arrays = {}
+    buffer = np.memmap(path, dtype=np.uint8, mode='r')
+    with zipfile.ZipFile(path) as archive, open(path, 'rb') as f:
+        for info in archive.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError(f'圧縮された配列はメモリマップできません: {info.filename}')
+            # ローカルファイルヘッダ(30バイト)の後ろにファイル名と拡張フィールドが続く
+            f.seek(info.header_offset)
+            header = f.read(30)
+            name_length, extra_length = struct.unpack('<HH', header[26:30])
+            f.seek(info.header_offset + 30 + name_length + extra_length)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            name = info.filename[:-len('.npy')] if info.filename.endswith('.npy') else info.filename
+            arrays[name] = np.ndarray(shape, dtype=dtype, buffer=buffer, offset=f.tell(),
+                                      order='F' if fortran_order else 'C')
+    return arrays
+
+
+class CompiledPCA:
+    """PCA.transform と同じ計算を行う。"""
+
+    def __init__(self, components, offset, scale=None):
+        self.components = components
+        self.offset = offset
+        self.scale = scale
+
+    @property
+    def n_components_(self):
+        return self.components.shape[0]
+
+    def transform(self, X):
+        X_transformed = X @ self.components.T
+        X_transformed -= self.offset
+        if self.scale is not None:
+            X_transformed /= self.scale
+        return X_transformed
+
+
+class CompiledIsolationForest:
+    """すべての木を同時にたどり、IsolationForest の score_samples / predict と同じ値を返す。"""
+
+    def __init__(self, arrays, feature_mode):
+        self.children_left = arrays['children_left']
+        self.children_right = arrays['children_right']
+        self.feature = arrays['feature']
+        self.threshold = arrays['threshold']
+        self.leaf_value = arrays['leaf_value']
+        self.roots = arrays['roots']
+        self.max_depth = int(arrays['max_depth'])
+        self.denominator = float(arrays['denominator'])
+        self.offset_ = float(arrays['offset'])
+        self.feature_mode = feature_mode
+
+    def apply(self, X):
+        # (サンプル数, 木の数) の葉のノード番号を返す
+        # scikit-learnの木と同じく float32 の値と float64 の閾値を比べる
+        X = np.asarray(X, dtype=np.float32)
+        rows = np.arange(len(X))[:, np.newaxis]
+        nodes = np.broadcast_to(self.roots, (len(X), len(self.roots))).copy()
+        for _ in range(self.max_depth):
+            left = self.children_left[nodes]
+            is_leaf = left == TREE_LEAF
+            if is_leaf.all():
+                break
+            go_left = X[rows, self.feature[nodes]] <= self.threshold[nodes]
+            nodes = np.where(is_leaf, nodes, np.where(go_left, left, self.children_right[nodes]))
+        return nodes
+
+    def score_samples(self, X):
+        leaves = self.apply(X)
+        depths = np.zeros(len(leaves))
+        # 浮動小数点の丸めまで一致させるため、scikit-learnと同じく木の順に足し合わせる
+        for tree in range(leaves.shape[1]):
+            depths += self.leaf_value[leaves[:, tree]]
+        if self.denominator == 0:
+            return -np.ones_like(depths)
+        return -(2 ** (-depths / self.denominator))
+
+    def decision_function(self, X):
+        return self.score_samples(X) - self.offset_
+
+    def predict(self, X):
+        return np.where(self.decision_function(X) < 0, -1, 1)
+
+
+def load_model(path):
+    # (PCA, Isolation Forest) を返す。PCAなしで学習したモデルでは PCA は None
+    arrays = load_npz_mmap(path)
+    if int(arrays['format_version']) != FORMAT_VERSION:
+        raise ValueError(f'未対応の形式です: {int(arrays["format_version"])}')
+    pca = None
+    if 'pca_components' in arrays:
+        pca = CompiledPCA(arrays['pca_components'], arrays['pca_offset'], arrays.get('pca_scale'))
+    return pca, CompiledIsolationForest(arrays, str(arrays['feature_mode']))
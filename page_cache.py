@@ -0,0 +1,139 @@
+import functools
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import pytz
+from flask import g, make_response, request
+from flask_login import current_user
+from sqlalchemy import func, select
+from werkzeug.http import is_resource_modified
+
+from models import db, Result, JST
+
+
+def find_page_version(user_id):
+    # ユーザーの結果が追加されたときだけ変わる (最後に追加された結果のid, 最新の検査日時)。
+    # それぞれ (user_id, id DESC) と (user_id, date DESC, id DESC) のインデックスを1回参照するだけで求まる
+    latest_id = select(func.max(Result.id)).where(Result.user_id == user_id).scalar_subquery()
+    latest_date = select(func.max(Result.date)).where(Result.user_id == user_id).scalar_subquery()
+    return tuple(db.session.execute(select(latest_id, latest_date)).one())
+
+
+def to_http_date(date):
+    # Result.date は日本時間で保存されている
+    if date is None:
+        return None
+    if date.tzinfo is None:
+        date = JST.localize(date)
+    return date.astimezone(pytz.utc)
+
+
+class PageCache:
+    """描画した検査記録の一覧をユーザーごとにプロセス内で保持する。
+
+    エントリはユーザーの結果のバージョンと結び付いており、結果が追加されると
+    （他のプロセスで追加された場合も）次に参照したときに破棄される。"""
+
+    # 1ユーザーあたりに保持するページ数
+    max_pages = 32
+
+    def __init__(self, app=None):
+        self.max_size = 1024
+        self.template_version = ''
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.max_size = app.config['PAGE_CACHE_SIZE']
+        self.template_version = self._template_version(app)
+        app.extensions['page_cache'] = self
+
+    def get(self, user_id, version, key):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            if entry[0] != version:
+                del self._entries[user_id]
+                return None
+            self._entries.move_to_end(user_id)
+            return entry[1].get(key)
+
+    def put(self, user_id, version, key, html):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or entry[0] != version:
+                entry = (version, {})
+                self._entries[user_id] = entry
+            pages = entry[1]
+            pages[key] = html
+            while len(pages) > self.max_pages:
+                del pages[next(iter(pages))]
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _template_version(self, app):
+        # デプロイでテンプレートや画面の文言が変わったら ETag も変わるよう、それらの内容から求める。
+        # 内容だけを使うので、同じコードならワーカーやサーバーが違っても同じ値になる
+        digest = hashlib.sha1()
+        template_folder = os.path.join(app.root_path, app.template_folder)
+        sources = [os.path.join(template_folder, name) for name in sorted(os.listdir(template_folder))]
+        sources.append(os.path.join(app.root_path, 'views.py'))
+        for path in sources:
+            if os.path.isfile(path):
+                digest.update(os.path.basename(path).encode())
+                with open(path, 'rb') as f:
+                    digest.update(f.read())
+        return digest.hexdigest()[:12]
+
+
+page_cache = PageCache()
+
+
+def conditional_page(view):
+    """ユーザーの結果のバージョンを ETag / Last-Modified として返し、
+    ブラウザが持っているページと同じなら描画せずに 304 Not Modified を返す。
+
+    view からは g.page_version でバージョンを参照できる。"""
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        user_id = current_user.id
+        g.page_version = find_page_version(user_id)
+        latest_id, latest_date = g.page_version
+        etag = f'{page_cache.template_version}-{user_id}-{latest_id or 0}'
+        # 過去の日付で追加された結果は Last-Modified では検出できないが、ETag のidで検出する
+        # （ブラウザは両方を送り、その場合は ETag が優先される）
+        last_modified = to_http_date(latest_date)
+        # これらのページはフラッシュメッセージを表示しない（login / register だけが表示して消す）ため、
+        # 表示待ちのメッセージがあっても 304 を返してよい
+        if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+            response = make_response('', 304)
+        else:
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        # ユーザーごとのページなので共有キャッシュには保存させず、毎回確認させる
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        response.vary.add('Cookie')
+        return response
+
+    return wrapper
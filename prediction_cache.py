@@ -0,0 +1,80 @@
+import threading
+from collections import OrderedDict
+
+from models import Result, Image
+from metrics import PREDICTION_CACHE
+
+
+class PredictionCache:
+    """(画像の内容ハッシュ, モデルのバージョン) をキーに判定結果を保持する。
+    プロセス内のLRUにない場合はDBの過去の結果を参照する。"""
+
+    def __init__(self, app=None):
+        self.max_size = 10000
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.db_hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.max_size = app.config['PREDICTION_CACHE_SIZE']
+        # モデルが差し替わったら古いバージョンの結果を破棄する
+        app.extensions['model_registry'].add_listener(lambda bundle: self.clear())
+        app.extensions['prediction_cache'] = self
+
+    def get(self, content_hash, model_version):
+        key = (content_hash, model_version)
+        with self._lock:
+            status = self._entries.get(key)
+            if status is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                PREDICTION_CACHE.labels('hit').inc()
+                return status
+
+        result = (Result.query.join(Image, Result.image_id == Image.id)
+                  .filter(Image.content_hash == content_hash, Result.model_version == model_version)
+                  .with_entities(Result.status)
+                  .first())
+        if result is None:
+            with self._lock:
+                self.misses += 1
+            PREDICTION_CACHE.labels('miss').inc()
+            return None
+
+        with self._lock:
+            self.db_hits += 1
+        PREDICTION_CACHE.labels('db_hit').inc()
+        self.put(content_hash, model_version, result.status)
+        return result.status
+
+    def put(self, content_hash, model_version, status):
+        key = (content_hash, model_version)
+        with self._lock:
+            self._entries[key] = status
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'db_hits': self.db_hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+            }
+
+
+prediction_cache = PredictionCache()
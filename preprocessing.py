@@ -0,0 +1,42 @@
+import cv2
+import numpy as np
+from PIL import Image as PILImage
+
+# モデルに入力する画像サイズ (幅, 高さ)
+IMAGE_SIZE = (128, 128)
+FEATURE_SIZE = IMAGE_SIZE[0] * IMAGE_SIZE[1] * 3
+
+
+def decode_image(source, size=IMAGE_SIZE):
+    # source はファイルパスまたはファイルオブジェクト。BGRの配列を返す
+    with PILImage.open(source) as image:
+        # JPEGは縮小デコード(1/2〜1/8)で目標サイズに近い解像度だけを展開する
+        image.draft('RGB', size)
+        rgb = np.asarray(image.convert('RGB'))
+    return cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR)
+
+
+def resize_pixels(image, size=IMAGE_SIZE):
+    # 最終的なリサイズ。正規化前の uint8 画素を1次元で返す
+    return cv2.resize(image, size, interpolation=cv2.INTER_AREA).reshape(-1)
+
+
+def normalize_pixels(pixels, out=None):
+    # 0〜1への正規化。out を渡すとその領域に書き込む
+    if out is None:
+        out = np.empty(pixels.shape, dtype=np.float32)
+    np.multiply(pixels, np.float32(1.0 / 255.0), out=out)
+    return out
+
+
+def image_to_vector(image, out=None, size=IMAGE_SIZE):
+    return normalize_pixels(resize_pixels(image, size), out=out)
+
+
+def load_pixels(source):
+    return resize_pixels(decode_image(source))
+
+
+def load_vector(source, out=None):
+    # 学習と推論で同じ特徴量になるよう、どちらもこの関数を使う
+    return image_to_vector(decode_image(source), out=out)
@@ -0,0 +1,241 @@
+import copy
+import json
+import os
+import time
+from datetime import datetime
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import func
+
+from models import db, Image, Result
+from inference import STATUS_NORMAL
+from storage import upload_storage
+
+STATE_FILENAME = 'retrain_state.json'
+
+retrain_cli = AppGroup('retrain', help='アップロードされた画像によるモデルの追加学習')
+
+
+def init_app(app):
+    app.cli.add_command(retrain_cli)
+
+
+def load_state(output_dir):
+    path = os.path.join(output_dir, STATE_FILENAME)
+    if not os.path.exists(path):
+        return {'last_image_id': 0}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_state(output_dir, state):
+    os.makedirs(output_dir, exist_ok=True)
+    path = os.path.join(output_dir, STATE_FILENAME)
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(state, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+
+
+def find_new_images(last_image_id, limit):
+    # 前回以降にアップロードされ、正常と判定された画像の (id, 保存先) を古い順に返す。
+    # 前処理済みの画像があればそちらを読む（原本が再圧縮されていても推論時と同じ入力になる）
+    rows = (db.session.query(Image.id, Image.content_hash,
+                             func.coalesce(Image.artifact_path, Image.storage_path))
+            .join(Result, Result.image_id == Image.id)
+            .filter(Image.id > last_image_id, Result.status == STATUS_NORMAL,
+                    Image.storage_path.isnot(None))
+            .order_by(Image.id)
+            .limit(limit)
+            .all())
+    # 同じ画像が何度もアップロードされていても1枚として扱う
+    seen = set()
+    images = []
+    for image_id, content_hash, storage_path in rows:
+        if content_hash not in seen:
+            seen.add(content_hash)
+            images.append((image_id, upload_storage.full_path(storage_path)))
+    return images, (rows[-1][0] if rows else last_image_id)
+
+
+def extract_features(paths, extractor, throttle):
+    # 読めない画像（保存前・削除済みなど）は除外する
+    import numpy as np
+    from preprocessing import decode_image
+    vectors = []
+    for path in paths:
+        try:
+            vectors.append(extractor.from_image(decode_image(path)))
+        except Exception as e:
+            click.echo(f'読み込みに失敗したためスキップします: {path}: {e}')
+        if throttle:
+            time.sleep(throttle)
+    return np.array(vectors, dtype=np.float32).reshape(len(vectors), extractor.size)
+
+
+def load_validation_set(validation_dir, extractor, throttle):
+    # 正解ラベル付きの検証データ (正常, 異常) を validation_dir/normal と validation_dir/abnormal から読む
+    from model_learning import list_images
+    sets = []
+    for label in ('normal', 'abnormal'):
+        label_dir = os.path.join(validation_dir, label)
+        X = extract_features(list_images(label_dir), extractor, throttle) if os.path.isdir(label_dir) else []
+        if len(X) == 0:
+            raise click.ClickException(f'検証用の画像がありません: {label_dir}')
+        sets.append(X)
+    return sets
+
+
+def normal_rate(pca, iso_forest, X):
+    Z = pca.transform(X) if pca is not None else X
+    return float((iso_forest.predict(Z) == 1).mean())
+
+
+def evaluate(pca, iso_forest, X_normal, X_abnormal):
+    # 正常画像を正常と、異常画像を異常と判定できた割合と、その平均（balanced accuracy）を返す
+    normal_accuracy = normal_rate(pca, iso_forest, X_normal)
+    abnormal_accuracy = 1.0 - normal_rate(pca, iso_forest, X_abnormal)
+    return {
+        'normal_accuracy': normal_accuracy,
+        'abnormal_accuracy': abnormal_accuracy,
+        'balanced_accuracy': (normal_accuracy + abnormal_accuracy) / 2,
+    }
+
+
+def lower_priority(niceness):
+    # リクエストの処理と競合しないよう、CPUの優先度を下げ、BLASのスレッドを1つに制限する
+    if niceness and hasattr(os, 'nice'):
+        os.nice(niceness)
+    from threadpoolctl import threadpool_limits
+    threadpool_limits(1)
+
+
+def retrain_once(options):
+    import joblib
+    from features import get_extractor
+    from model_registry import model_registry, publish_manifest
+    from numpy_engine import export_model
+
+    config = current_app.config
+    state = load_state(options['output_dir'])
+    images, last_image_id = find_new_images(state['last_image_id'], options['max_images'])
+    if len(images) < options['min_new_images']:
+        click.echo(f'新しい画像が{len(images)}枚のため追加学習しません（{options["min_new_images"]}枚以上で実行）')
+        return False
+
+    pca_path, iso_forest_path, _ = model_registry.model_paths()
+    pca = joblib.load(pca_path)
+    iso_forest = joblib.load(iso_forest_path)
+    extractor = get_extractor(getattr(iso_forest, 'feature_mode', None))
+    current_forest = copy.deepcopy(iso_forest)
+
+    started = time.perf_counter()
+    # 新しい画像は現在のモデルが正常と判定したものなので、検証には使わない（現在のモデルとの一致しか測れない）。
+    # 検証は正解ラベル付きの正常・異常画像で行う
+    X_train = extract_features([path for _, path in images], extractor, options['throttle'])
+    X_normal, X_abnormal = load_validation_set(options['validation_dir'], extractor, options['throttle'])
+    click.echo(f'{len(X_train)}枚で学習し、正常{len(X_normal)}枚・異常{len(X_abnormal)}枚で検証します '
+               f'(features={extractor.mode}, {time.perf_counter() - started:.1f}秒)')
+
+    n_estimators = len(iso_forest.estimators_) + options['add_estimators']
+    if n_estimators > options['max_estimators']:
+        click.echo(f'木の数が上限({options["max_estimators"]})を超えるため追加学習しません。'
+                   'model_learning.py で学習し直してください')
+        return False
+    # 経路長の正規化は1本あたりのサンプル数で決まるため、追加する木も既存の木と同じ数で学習する
+    max_samples = iso_forest.max_samples_
+    if len(X_train) < max_samples:
+        click.echo(f'学習に使える画像が{len(X_train)}枚のため追加学習しません（既存の木と同じ{max_samples}枚以上が必要）')
+        return False
+    # 既存の木はそのままに、新しい画像で学習した木を追加する
+    iso_forest.set_params(warm_start=True, n_estimators=n_estimators, max_samples=max_samples)
+    iso_forest.fit(pca.transform(X_train) if pca is not None else X_train)
+    iso_forest.set_params(warm_start=False)
+    # fit は新しい画像だけで閾値を決め直すが、それらは現在のモデルが正常と判定済みの偏った標本なので、
+    # 学習データ全体で決めた閾値を引き継ぐ
+    iso_forest.offset_ = current_forest.offset_
+
+    before = evaluate(pca, current_forest, X_normal, X_abnormal)
+    after = evaluate(pca, iso_forest, X_normal, X_abnormal)
+    accepted = after['balanced_accuracy'] >= before['balanced_accuracy'] - options['max_drop']
+    click.echo(f'検証: 正常の正解率 {before["normal_accuracy"]:.3f} -> {after["normal_accuracy"]:.3f}, '
+               f'異常の検出率 {before["abnormal_accuracy"]:.3f} -> {after["abnormal_accuracy"]:.3f}, '
+               f'平均 {before["balanced_accuracy"]:.3f} -> {after["balanced_accuracy"]:.3f} '
+               f'({"採用" if accepted else "不採用"})')
+
+    state.update(last_image_id=last_image_id, last_run_at=datetime.now().isoformat(),
+                 last_result='accepted' if accepted else 'rejected')
+    if not accepted:
+        # 同じ画像で何度も学習し直さないよう、不採用でも処理済みとして記録する
+        save_state(options['output_dir'], state)
+        return False
+
+    version = datetime.now().strftime('%Y%m%d%H%M%S')
+    version_dir = os.path.join(options['output_dir'], version)
+    os.makedirs(version_dir, exist_ok=True)
+    pca_path = os.path.join(version_dir, 'pca_model.pkl')
+    iso_forest_path = os.path.join(version_dir, 'iso_forest_model.pkl')
+    compiled_path = os.path.join(version_dir, 'model.npz')
+    joblib.dump(pca, pca_path)
+    joblib.dump(iso_forest, iso_forest_path)
+    export_model(compiled_path, pca, iso_forest, extractor.mode)
+    metadata = {
+        'version': version,
+        'created_at': datetime.now().isoformat(),
+        'method': 'warm_start',
+        'features': extractor.mode,
+        'n_images': len(X_train),
+        'validation_dir': options['validation_dir'],
+        'n_validation_normal': len(X_normal),
+        'n_validation_abnormal': len(X_abnormal),
+        'last_image_id': last_image_id,
+        'n_estimators': len(iso_forest.estimators_),
+        'validation_before': before,
+        'validation_after': after,
+    }
+    with open(os.path.join(version_dir, 'metadata.json'), 'w') as f:
+        json.dump(metadata, f, ensure_ascii=False, indent=2)
+
+    # マニフェストの置き換え1回で反映するため、サーバーが新旧のモデルを組み合わせて読むことはない
+    publish_manifest(config['MODEL_MANIFEST_PATH'], pca_path, iso_forest_path, compiled_path, version)
+    state['last_version'] = version
+    save_state(options['output_dir'], state)
+    click.echo(f'モデルを更新しました: {version_dir}')
+    return True
+
+
+@retrain_cli.command('run')
+@click.option('--loop', is_flag=True, help='終了せずに --interval ごとに繰り返す')
+@click.option('--interval', type=float, default=3600, help='繰り返すときの間隔(秒)')
+@click.option('--min-new-images', type=int, default=50, help='この枚数以上の新しい画像があるときだけ学習する')
+@click.option('--max-images', type=int, default=1000, help='1回の学習に使う画像の上限')
+@click.option('--add-estimators', type=int, default=20, help='1回の学習で追加する木の数')
+@click.option('--max-estimators', type=int, default=500, help='木の数の上限')
+@click.option('--validation-dir', required=True, type=click.Path(exists=True, file_okay=False),
+              help='正解ラベル付きの検証データ（normal/ と abnormal/ に画像を置く）')
+@click.option('--max-drop', type=float, default=0.05, help='検証で許容する balanced accuracy の低下')
+@click.option('--output-dir', default='models', help='バージョンごとの成果物と処理状況の保存先')
+@click.option('--nice', type=int, default=10, help='プロセスの優先度を下げる量')
+@click.option('--throttle', type=float, default=0.0, help='画像1枚を読み込むごとに待つ秒数')
+def run_command(loop, interval, nice, **options):
+    """正常と判定された新しい画像でモデルを追加学習し、検証に通れば反映する
+
+    アップロードされた画像（UPLOAD_FOLDER）を読み、公開したモデルのマニフェストを
+    サーバーが読み込むため、Webプロセスとファイルシステムを共有するホストで実行する。
+    Heroku のように dyno ごとにファイルシステムが分かれる環境では、別の dyno で動かしても
+    画像を読めず、学習したモデルもサーバーに届かない。"""
+    lower_priority(nice)
+    while True:
+        try:
+            retrain_once(options)
+        except Exception as e:
+            if not loop:
+                raise
+            click.echo(f'追加学習中のエラー: {e}')
+        finally:
+            db.session.remove()
+        if not loop:
+            return
+        time.sleep(interval)
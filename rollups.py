@@ -0,0 +1,110 @@
+from collections import Counter
+from datetime import date, timedelta
+
+import click
+from sqlalchemy import func
+from flask.cli import AppGroup
+
+from models import db, Result, ResultRollup, now_jst
+
+PERIOD_DAY = 'day'
+PERIOD_WEEK = 'week'
+
+rollups_cli = AppGroup('rollups', help='ユーザーごとの日次・週次集計')
+
+
+def init_app(app):
+    app.cli.add_command(rollups_cli)
+
+
+def period_start(day, period):
+    # 週は月曜日始まり
+    if period == PERIOD_WEEK:
+        return day - timedelta(days=day.weekday())
+    return day
+
+
+def record_results(results):
+    # Resultの追加と同じトランザクション内で、日次・週次の件数を加算する
+    counts = Counter()
+    for result in results:
+        day = result.date.date()
+        for period in (PERIOD_DAY, PERIOD_WEEK):
+            counts[(result.user_id, period, period_start(day, period), result.status)] += 1
+    for (user_id, period, start, status), count in counts.items():
+        _increment(user_id, period, start, status, count)
+
+
+def _increment(user_id, period, start, status, count):
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        insert = None
+
+    if insert is not None:
+        # 同時に別のリクエストが同じ行を作っても件数が失われないようUPSERTで加算する
+        stmt = insert(ResultRollup).values(user_id=user_id, period=period, period_start=start,
+                                           status=status, count=count)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['user_id', 'period', 'period_start', 'status'],
+            set_={'count': ResultRollup.count + stmt.excluded['count']})
+        db.session.execute(stmt)
+        return
+
+    rollup = ResultRollup.query.filter_by(user_id=user_id, period=period, period_start=start,
+                                          status=status).with_for_update().first()
+    if rollup is None:
+        db.session.add(ResultRollup(user_id=user_id, period=period, period_start=start,
+                                    status=status, count=count))
+    else:
+        rollup.count += count
+
+
+def find_trends(user_id, period, periods, today=None):
+    # 集計テーブルだけを読み、表示する期間の数に比例したコストで推移を返す
+    today = today or now_jst().date()
+    step = timedelta(weeks=1) if period == PERIOD_WEEK else timedelta(days=1)
+    last = period_start(today, period)
+    first = last - step * (periods - 1)
+    rollups = (ResultRollup.query
+               .filter(ResultRollup.user_id == user_id, ResultRollup.period == period,
+                       ResultRollup.period_start >= first)
+               .all())
+    counts = {}
+    for rollup in rollups:
+        counts.setdefault(rollup.period_start, Counter())[rollup.status] += rollup.count
+    trends = []
+    for index in range(periods):
+        start = first + step * index
+        trends.append((start, counts.get(start, Counter())))
+    return trends
+
+
+@rollups_cli.command('backfill')
+@click.option('--user-id', type=int, default=None, help='指定したユーザーだけを集計し直す')
+def backfill_command(user_id):
+    """既存のResultから集計テーブルを作り直す"""
+    rollups = ResultRollup.query
+    day_column = func.date(Result.date)
+    query = db.session.query(Result.user_id, day_column, Result.status, func.count(Result.id))
+    if user_id is not None:
+        rollups = rollups.filter_by(user_id=user_id)
+        query = query.filter(Result.user_id == user_id)
+    rollups.delete(synchronize_session=False)
+
+    counts = Counter()
+    for row_user_id, day, status, count in query.group_by(Result.user_id, day_column, Result.status):
+        if isinstance(day, str):
+            day = date.fromisoformat(day)
+        for period in (PERIOD_DAY, PERIOD_WEEK):
+            counts[(row_user_id, period, period_start(day, period), status)] += count
+
+    db.session.bulk_insert_mappings(ResultRollup, [
+        {'user_id': row_user_id, 'period': period, 'period_start': start, 'status': status, 'count': count}
+        for (row_user_id, period, start, status), count in counts.items()
+    ])
+    db.session.commit()
+    click.echo(f'{len(counts)}件の集計行を作成しました')
@@ -0,0 +1,53 @@
+import gc
+import sys
+import time
+from contextlib import contextmanager
+
+# 起動時に読み込まれているかを報告する重いモジュール
+HEAVY_MODULES = ('numpy', 'cv2', 'PIL', 'sklearn', 'joblib')
+
+
+class StartupTimer:
+    """起動処理を段階ごとに計測し、所要時間と新たに読み込まれたモジュール数を記録する。"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.steps = []
+
+    @contextmanager
+    def step(self, name):
+        started = time.perf_counter()
+        modules = len(sys.modules)
+        try:
+            yield
+        finally:
+            self.steps.append((name, time.perf_counter() - started, len(sys.modules) - modules))
+
+    def report(self):
+        total = time.perf_counter() - self.started
+        lines = [f'起動時間: {total * 1000:.0f}ms']
+        for name, seconds, modules in sorted(self.steps, key=lambda step: step[1], reverse=True):
+            lines.append(f'  {name}: {seconds * 1000:.1f}ms (+{modules} modules)')
+        loaded = [name for name in HEAVY_MODULES if name in sys.modules]
+        lines.append(f'  読み込み済みの重いモジュール: {", ".join(loaded) or "なし"}')
+        return '\n'.join(lines)
+
+
+def warm_up(app, timer):
+    # gunicorn --preload ではfork前のマスターで実行され、ワーカーは読み込み済みのモジュールと
+    # モデルをコピーオンライトで共有する
+    registry = app.extensions['model_registry']
+    with timer.step('warm-up: import imaging modules'):
+        import numpy as np
+        import preprocessing  # noqa: F401  OpenCV と PIL
+    with timer.step('warm-up: load model'):
+        model = registry.load()
+    with timer.step('warm-up: first inference'):
+        # 初回の推論でだけ発生する遅延初期化を済ませておく（メトリクスには記録しない）
+        X = np.zeros((1, model.features.size), dtype=np.float32)
+        if model.pca is not None:
+            X = model.pca.transform(X)
+        model.iso_forest.predict(X)
+    # ここまでに作られたオブジェクトをGCの対象から外し、ワーカーでのGCが
+    # 共有ページに書き込んでコピーが発生するのを防ぐ
+    gc.freeze()
@@ -0,0 +1,91 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import timed
+
+
+class UploadStorage:
+    """アップロードされた原本を内容ハッシュで決まるパスに保存する。
+    書き込みはバックグラウンドのスレッドで行い、リクエストを待たせない。"""
+
+    def __init__(self, app=None):
+        self.root = 'uploads'
+        self.max_workers = 2
+        self.logger = None
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.root = app.config['UPLOAD_FOLDER']
+        self.max_workers = app.config['UPLOAD_WRITER_THREADS']
+        self.logger = app.logger
+        app.extensions['upload_storage'] = self
+
+    def path_for(self, content_hash, ext):
+        # 1階層に大量のファイルが並ばないよう、ハッシュの先頭4文字で2階層に分ける
+        return os.path.join(content_hash[:2], content_hash[2:4], f'{content_hash}{ext}')
+
+    def full_path(self, storage_path):
+        return os.path.join(self.root, storage_path)
+
+    def store(self, data, content_hash, ext):
+        storage_path = self.path_for(content_hash, ext.lower())
+        self._get_executor().submit(self._write, data, self.full_path(storage_path))
+        return storage_path
+
+    def save(self, data, content_hash, ext):
+        # 呼び出し元のスレッドでそのまま書き込む（一括取り込みのワーカープロセスなど）。失敗したら例外を送出する
+        storage_path = self.path_for(content_hash, ext.lower())
+        self._write_file(data, self.full_path(storage_path))
+        return storage_path
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=wait)
+                self._executor = None
+
+    def _get_executor(self):
+        # fork後の子プロセスではスレッドが引き継がれないため、プロセスごとに作り直す
+        if self._executor is None or self._pid != os.getpid():
+            with self._lock:
+                if self._executor is None or self._pid != os.getpid():
+                    self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                        thread_name_prefix='upload-writer')
+                    self._pid = os.getpid()
+        return self._executor
+
+    def _write(self, data, path):
+        try:
+            if self._write_file(data, path):
+                self._log('info', f'ファイルを保存しました: {path}')
+        except Exception as e:
+            self._log('error', f'ファイルの保存に失敗しました: {path}: {e}')
+
+    def _write_file(self, data, path):
+        # 書き込んだら True、同じ内容の画像がすでに保存済みなら False を返す
+        # 保存済みのファイルを再利用するときは更新日時を今にして、参照する行が
+        # コミットされる前に storage maintain の削除対象にならないようにする
+        try:
+            os.utime(path)
+            return False
+        except FileNotFoundError:
+            pass
+        with timed('file_save'):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        return True
+
+    def _log(self, level, message):
+        if self.logger is not None:
+            getattr(self.logger, level)(message)
+
+
+upload_storage = UploadStorage()
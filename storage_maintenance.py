@@ -0,0 +1,218 @@
+import io
+import os
+import time
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import func
+
+from models import db, Image
+from storage import upload_storage
+
+ARTIFACT_EXT = '.128.png'
+RECOMPRESSED_EXTS = {'JPEG': '.r.jpg', 'WEBP': '.r.webp'}
+
+storage_cli = AppGroup('storage', help='アップロードされた画像の保存領域のメンテナンス')
+
+
+def init_app(app):
+    app.cli.add_command(storage_cli)
+
+
+class IOThrottle:
+    """読み書きしたバイト数が指定した速度を超えないよう待つ。"""
+
+    def __init__(self, bytes_per_second):
+        self.rate = bytes_per_second
+        self.started = time.monotonic()
+        self.total = 0
+
+    def consume(self, size):
+        if not self.rate:
+            return
+        self.total += size
+        wait = self.total / self.rate - (time.monotonic() - self.started)
+        if wait > 0:
+            time.sleep(wait)
+
+
+def read_file(path, throttle):
+    with open(path, 'rb') as f:
+        data = f.read()
+    throttle.consume(len(data))
+    return data
+
+
+def create_artifacts(throttle, limit, dry_run):
+    # 推論と同じ前処理をした128x128の画素をPNG（可逆）で保存する。
+    # 原本を再圧縮した後も、モデルへの入力は元の画像と完全に同じものを再現できる
+    import cv2
+    from preprocessing import IMAGE_SIZE, decode_image, resize_pixels
+
+    rows = (db.session.query(Image.content_hash, Image.storage_path)
+            .filter(Image.artifact_path.is_(None), Image.storage_path.isnot(None))
+            .group_by(Image.content_hash, Image.storage_path)
+            .order_by(func.min(Image.id))
+            .limit(limit)
+            .all())
+    created = 0
+    for content_hash, storage_path in rows:
+        source = upload_storage.full_path(storage_path)
+        if not os.path.exists(source):
+            # まだ書き込み中か、すでに失われている
+            continue
+        if dry_run:
+            created += 1
+            continue
+        try:
+            pixels = resize_pixels(decode_image(io.BytesIO(read_file(source, throttle))))
+            ok, encoded = cv2.imencode('.png', pixels.reshape(IMAGE_SIZE[1], IMAGE_SIZE[0], 3))
+            if not ok:
+                raise ValueError('PNGに変換できません')
+            artifact_path = upload_storage.save(encoded.tobytes(), content_hash, ARTIFACT_EXT)
+            throttle.consume(len(encoded))
+        except Exception as e:
+            click.echo(f'前処理済み画像を作成できませんでした: {storage_path}: {e}')
+            continue
+        (Image.query.filter(Image.content_hash == content_hash, Image.artifact_path.is_(None))
+         .update({Image.artifact_path: artifact_path}, synchronize_session=False))
+        db.session.commit()
+        created += 1
+    return created
+
+
+def recompress_originals(throttle, limit, dry_run):
+    # 最後にアップロードされてから一定日数が過ぎた原本を、縮小・再圧縮した画像に置き換える
+    from PIL import Image as PILImage
+
+    config = current_app.config
+    image_format = config['STORAGE_RECOMPRESS_FORMAT'].upper()
+    max_edge = config['STORAGE_RECOMPRESS_MAX_EDGE']
+    cutoff = datetime.utcnow() - timedelta(days=config['STORAGE_RECOMPRESS_AFTER_DAYS'])
+    rows = (db.session.query(Image.content_hash, Image.storage_path)
+            .filter(Image.compacted_at.is_(None), Image.artifact_path.isnot(None),
+                    Image.storage_path.isnot(None))
+            .group_by(Image.content_hash, Image.storage_path)
+            .having(func.max(Image.date) < cutoff)
+            .order_by(func.min(Image.id))
+            .limit(limit)
+            .all())
+    replaced, saved_bytes = 0, 0
+    for content_hash, storage_path in rows:
+        source = upload_storage.full_path(storage_path)
+        if not os.path.exists(source):
+            continue
+        try:
+            data = read_file(source, throttle)
+            with PILImage.open(io.BytesIO(data)) as image:
+                exif = image.info.get('exif')
+                image = image.convert('RGB')
+                image.thumbnail((max_edge, max_edge), PILImage.LANCZOS)
+                buffer = io.BytesIO()
+                # 向きの情報が失われないようEXIFは引き継ぐ
+                image.save(buffer, format=image_format, quality=config['STORAGE_RECOMPRESS_QUALITY'],
+                           **({'exif': exif} if exif else {}))
+            compressed = buffer.getvalue()
+        except Exception as e:
+            click.echo(f'再圧縮できませんでした: {storage_path}: {e}')
+            continue
+
+        rows_to_update = Image.query.filter(Image.content_hash == content_hash, Image.storage_path == storage_path)
+        if len(compressed) >= len(data):
+            # 小さくならない画像は原本のまま、処理済みとして記録する
+            if not dry_run:
+                rows_to_update.update({Image.compacted_at: datetime.utcnow()}, synchronize_session=False)
+                db.session.commit()
+            continue
+        replaced += 1
+        saved_bytes += len(data) - len(compressed)
+        if dry_run:
+            continue
+
+        new_path = upload_storage.save(compressed, content_hash, RECOMPRESSED_EXTS[image_format])
+        throttle.consume(len(compressed))
+        rows_to_update.update({Image.storage_path: new_path, Image.compacted_at: datetime.utcnow()},
+                              synchronize_session=False)
+        db.session.commit()
+        # 同じ内容の画像がちょうどアップロードされ、まだコミットされていない行がこの原本を参照する
+        # かもしれないので、ここでは削除しない。更新日時を今にして、猶予時間が過ぎてから
+        # 参照されていなければ collect_garbage で削除する
+        os.utime(source)
+    return replaced, saved_bytes
+
+
+def collect_garbage(throttle, dry_run):
+    # どの Image からも参照されていないファイルを削除する。書き込み直後でまだ行が
+    # コミットされていないファイルを消さないよう、更新から猶予時間が過ぎたものだけを対象にする
+    grace = current_app.config['STORAGE_GC_GRACE_HOURS'] * 3600
+    referenced = set()
+    for storage_path, artifact_path in db.session.query(Image.storage_path, Image.artifact_path):
+        referenced.add(storage_path)
+        referenced.add(artifact_path)
+
+    removed, removed_bytes = 0, 0
+    now = time.time()
+    root = upload_storage.root
+    for directory, _, filenames in os.walk(root):
+        relative_dir = os.path.relpath(directory, root)
+        # ハッシュで分けた2階層目のファイルだけを対象にする（直下の古い形式のファイルには触れない）
+        if relative_dir.count(os.sep) != 1 or relative_dir == '.':
+            continue
+        for filename in filenames:
+            storage_path = os.path.join(relative_dir, filename)
+            if storage_path in referenced:
+                continue
+            path = os.path.join(directory, filename)
+            stat = os.stat(path)
+            if now - stat.st_mtime < grace:
+                continue
+            if not dry_run:
+                os.remove(path)
+                throttle.consume(4096)
+            removed += 1
+            removed_bytes += stat.st_size
+    return removed, removed_bytes
+
+
+@storage_cli.command('maintain')
+@click.option('--artifacts/--no-artifacts', default=True, help='前処理済みの128x128画像を作る')
+@click.option('--recompress/--no-recompress', default=True, help='古い原本を再圧縮する')
+@click.option('--gc/--no-gc', 'gc_enabled', default=True, help='参照されていないファイルを削除する')
+@click.option('--limit', type=int, default=1000, help='1回に処理する画像の上限')
+@click.option('--dry-run', is_flag=True, help='変更せずに対象の件数だけを表示する')
+@click.option('--loop', is_flag=True, help='終了せずに --interval ごとに繰り返す')
+@click.option('--interval', type=float, default=3600, help='繰り返すときの間隔(秒)')
+@click.option('--nice', type=int, default=10, help='プロセスの優先度を下げる量')
+def maintain_command(artifacts, recompress, gc_enabled, limit, dry_run, loop, interval, nice):
+    """前処理済み画像の作成、古い原本の再圧縮、参照されていないファイルの削除を行う
+
+    Webプロセスの UPLOAD_FOLDER を直接読み書きするため、同じファイルシステムを共有する
+    ホストで実行する。Heroku のように dyno ごとにファイルシステムが分かれる環境では、
+    別の dyno で動かしても保存された画像は見えない。"""
+    from retraining import lower_priority
+    lower_priority(nice)
+    while True:
+        throttle = IOThrottle(current_app.config['STORAGE_IO_LIMIT_MB'] * 1024 * 1024)
+        started = time.perf_counter()
+        try:
+            if artifacts:
+                click.echo(f'前処理済み画像を作成しました: {create_artifacts(throttle, limit, dry_run)}件')
+            if recompress:
+                count, saved_bytes = recompress_originals(throttle, limit, dry_run)
+                click.echo(f'原本を再圧縮しました: {count}件 (削減 {saved_bytes / 1024 / 1024:.1f}MB)')
+            if gc_enabled:
+                removed, removed_bytes = collect_garbage(throttle, dry_run)
+                click.echo(f'参照されていないファイルを削除しました: {removed}件 ({removed_bytes / 1024 / 1024:.1f}MB)')
+        except Exception as e:
+            db.session.rollback()
+            if not loop:
+                raise
+            click.echo(f'メンテナンス中のエラー: {e}')
+        finally:
+            db.session.remove()
+        click.echo(f'メンテナンスが完了しました ({time.perf_counter() - started:.1f}秒)')
+        if not loop:
+            return
+        time.sleep(interval)
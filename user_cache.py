@@ -0,0 +1,73 @@
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import inspect
+from sqlalchemy.orm import make_transient_to_detached
+
+from models import db, User
+
+
+class UserCache:
+    """ログイン中のユーザーの列の値をプロセスごとに一定時間保持し、
+    リクエストごとの current_user の復元でDBを参照しないようにする。
+
+    キャッシュするのはORMオブジェクトではなく列の値で、取り出すたびに
+    そのリクエストのセッションへSELECTなしで結び付け直す。"""
+
+    def __init__(self, app=None):
+        self.max_size = 1024
+        self.ttl = 60.0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.max_size = app.config['USER_CACHE_SIZE']
+        self.ttl = app.config['USER_CACHE_TTL']
+        app.extensions['user_cache'] = self
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                expires_at, values = entry
+                if time.monotonic() < expires_at:
+                    self._entries.move_to_end(user_id)
+                    return self._attach(values)
+                del self._entries[user_id]
+
+        user = db.session.get(User, user_id)
+        if user is not None:
+            self.put(user)
+        return user
+
+    def put(self, user):
+        if self.max_size <= 0:
+            return
+        values = {attr.key: getattr(user, attr.key) for attr in inspect(User).column_attrs}
+        with self._lock:
+            self._entries[user.id] = (time.monotonic() + self.ttl, values)
+            self._entries.move_to_end(user.id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        # 他のワーカープロセスのキャッシュは TTL が切れるまで古い値を返す
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _attach(self, values):
+        user = User(**values)
+        # 読み込み済みの永続オブジェクトとして扱い、load=False でSELECTせずにセッションへ加える。
+        # 同じセッションにすでにあればそのオブジェクトが返る
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
+
+user_cache = UserCache()
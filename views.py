@@ -1,44 +1,57 @@
-from flask import request, jsonify, render_template, redirect, url_for, flash
-from app import app, db, bcrypt
-from models import User, Result, Image
+from flask import (Blueprint, current_app, g, request, jsonify, render_template, redirect, url_for, flash,
+                   Response, stream_with_context)
+from app import bcrypt
+from models import db, User, Result, Image, InferenceJob, now_jst
+from model_registry import model_registry
+from inference import predict_statuses, STATUS_NORMAL, STATUS_ABNORMAL
+from inference_queue import inference_dispatcher
+from prediction_cache import prediction_cache
+from user_cache import user_cache
+from page_cache import page_cache, conditional_page
+from storage import upload_storage
+from jobs import job_runner, JOB_DONE, JOB_FAILED, JOB_QUEUED
+from rollups import record_results, find_trends, PERIOD_DAY, PERIOD_WEEK
+import metrics
+from metrics import timed, record_error
 from forms import LoginForm, RegisterForm
 from flask_login import login_user, login_required, logout_user, current_user
+from markupsafe import Markup
 from datetime import datetime
-import cv2
-import numpy as np
-from PIL import Image as PILImage
+from functools import partial
+from sqlalchemy import tuple_
+import hashlib
 import io
-import joblib
-import pytz
+import json
+import time
 from werkzeug.utils import secure_filename
 import os
 
+bp = Blueprint('main', __name__)
+
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
-UPLOAD_FOLDER = 'uploads'
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-@app.route('/login', methods=['GET', 'POST'])
+@bp.route('/login', methods=['GET', 'POST'])
 def login():
     form = LoginForm()
     if request.method == 'POST' and form.validate_on_submit():
         user = User.query.filter_by(username=form.username.data).first()
         if user and bcrypt.check_password_hash(user.password, form.password.data):
             login_user(user, remember=form.remember.data)
-            return redirect(url_for('home'))
+            return redirect(url_for('main.home'))
         else:
             flash('ユーザー名またはパスワードが正しくありません。', 'danger')
-            return redirect(url_for('login'))
+            return redirect(url_for('main.login'))
     elif request.method == 'POST':
         for field, errors in form.errors.items():
             for error in errors:
                 flash(f"{getattr(form, field).label.text}のエラー - {error}", 'danger')
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
     return render_template('login.html', form=form)
 
-@app.route('/register', methods=['GET', 'POST'])
+@bp.route('/register', methods=['GET', 'POST'])
 def register():
     form = RegisterForm()
     if request.method == 'POST' and form.validate_on_submit():
@@ -50,155 +63,454 @@ def register():
         db.session.commit()
         login_user(new_user)
         flash('登録が完了しました。自動的にログインしました。', 'success')
-        return redirect(url_for('home'))
+        return redirect(url_for('main.home'))
     elif request.method == 'POST':
         for field, errors in form.errors.items():
             for error in errors:
                 flash(f"{getattr(form, field).label.text}のエラー - {error}", 'danger')
-        return redirect(url_for('register'))
+        return redirect(url_for('main.register'))
     return render_template('register.html', form=form)
 
-@app.route('/logout')
+@bp.route('/logout')
 @login_required
 def logout():
     logout_user()
-    return redirect(url_for('login'))
+    return redirect(url_for('main.login'))
 
-@app.route('/')
+@bp.route('/')
 @login_required
+@conditional_page
 def home():
-    latest_result = Result.query.filter_by(user_id=current_user.id).order_by(Result.date.desc()).first()
+    latest_result = find_latest_result(current_user.id)
     
     health_advice = ""
     if latest_result:
         status = latest_result.status
-        if status == "正常":
+        if status == STATUS_NORMAL:
             health_advice = "健康な尿です。水分をしっかり摂りましょう。"
         else:
             health_advice = "異常な色です。医師の診察を受けてください。"
     
     return render_template('home.html', latest_result=latest_result, health_advice=health_advice)
 
-@app.route('/upload')
+@bp.route('/upload')
 @login_required
 def upload():
-    return render_template('upload.html')
+    return render_template('upload.html', async_uploads=current_app.config['ASYNC_UPLOADS'])
+
+# ステータスごとに表示するメッセージ
+STATUS_MESSAGES = {
+    STATUS_NORMAL: ("おめでとうございます！検査結果は正常です。<br><br>"
+                    "健康な尿の色は淡黄色から濃い黄色の範囲です。尿の色が透明や淡い黄色である場合、水分をしっかり摂取している証拠です。"
+                    "日中や運動後には、十分な水分補給を心がけてください。また、朝一番の尿が濃い黄色であっても心配いりません。"
+                    "これは体が夜間に尿を濃縮して水分を保持しようとするためです。<br><br>"
+                    "引き続き、バランスの取れた食事と規則正しい生活を心がけ、健康を維持してください。"),
+    STATUS_ABNORMAL: ("検査結果は異常を示しています。<br><br>"
+                      "尿の色が赤色、茶色、または異常に濃い色である場合、何らかの健康問題が考えられます。"
+                      "例えば、赤色の尿は血尿の可能性があり、腎臓や尿路に問題があるかもしれません。"
+                      "茶色の尿は肝臓や胆道の問題を示している可能性があります。<br><br>"
+                      "このような結果が出た場合は、速やかに医師の診察を受けることを強くお勧めします。"
+                      "また、日々の生活習慣を見直し、適切な水分摂取やバランスの取れた食事を心がけましょう。"),
+}
+
+def receive_upload(file):
+    # アップロードされたデータを順に読みながら内容ハッシュを計算し、メモリ上に保持する
+    digest = hashlib.sha256()
+    buffer = io.BytesIO()
+    for chunk in iter(lambda: file.stream.read(1 << 16), b''):
+        digest.update(chunk)
+        buffer.write(chunk)
+    content_hash = digest.hexdigest()
+    data = buffer.getvalue()
+
+    # 原本の保存はバックグラウンドで行い、推論にはメモリ上のデータを使う
+    filename = secure_filename(file.filename)
+    storage_path = upload_storage.store(data, content_hash, os.path.splitext(filename)[1])
+    current_app.logger.info(f'ファイルを保存します: {storage_path}')
+    return filename, data, content_hash, storage_path
 
-@app.route('/upload_image', methods=['POST'])
+def preprocess_upload(data, features, out=None):
+    # features は推論に使うモデルの特徴量抽出器。
+    # OpenCVやPILの読み込みは重いため、起動時ではなく最初の推論時に行う
+    from preprocessing import decode_image
+    with timed('decode'):
+        image = decode_image(io.BytesIO(data))
+    with timed('preprocess'):
+        return features.from_image(image, out=out)
+
+@bp.route('/upload_image', methods=['POST'])
 @login_required
 def upload_image():
-    app.logger.info('アップロード開始')
+    current_app.logger.info('アップロード開始')
     if 'image' not in request.files:
-        app.logger.error('ファイルがありません。')
+        current_app.logger.error('ファイルがありません。')
         flash('ファイルがありません。', 'danger')
-        return redirect(url_for('upload'))
+        return redirect(url_for('main.upload'))
 
     file = request.files['image']
     if file.filename == '':
-        app.logger.error('ファイルが選択されていません。')
+        current_app.logger.error('ファイルが選択されていません。')
         flash('ファイルが選択されていません。', 'danger')
-        return redirect(url_for('upload'))
+        return redirect(url_for('main.upload'))
 
     if file and allowed_file(file.filename):
+        metrics.UPLOADS.labels('upload_image').inc()
         try:
-            filename = secure_filename(file.filename)
-            file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            app.logger.info(f'ファイルパス: {file_path}')
-            if not os.path.exists(app.config['UPLOAD_FOLDER']):
-                os.makedirs(app.config['UPLOAD_FOLDER'])
-                app.logger.info(f'アップロードフォルダを作成しました: {app.config["UPLOAD_FOLDER"]}')
-            
-            file.save(file_path)
-            app.logger.info(f'ファイルを保存しました: {file_path}')
-
-            new_image = Image(filename=filename, user_id=current_user.id)
+            filename, data, content_hash, storage_path = receive_upload(file)
+
+            new_image = Image(filename=filename, content_hash=content_hash, storage_path=storage_path,
+                              user_id=current_user.id)
             db.session.add(new_image)
-            db.session.commit()
-            app.logger.info(f'画像情報をデータベースに保存しました: {filename}')
-
-            image = PILImage.open(file_path)
-            image = cv2.cvtColor(np.array(image), cv2.COLOR_RGB2BGR)
-            image = cv2.resize(image, (128, 128)).flatten() / 255.0
-
-            # モデルの読み込み
-            pca = joblib.load('pca_model.pkl')
-            iso_forest = joblib.load('iso_forest_model.pkl')
-            app.logger.info('モデルを読み込みました')
-
-            # 画像データの前処理
-            image_pca = pca.transform([image])
-            prediction = iso_forest.predict(image_pca)
-            app.logger.info(f'画像処理結果: {prediction}')
-
-            status = "正常" if prediction == 1 else "異常"
-
-            # ステータスに基づいたメッセージの設定
-            if status == "正常":
-                message = ("おめでとうございます！検査結果は正常です。<br><br>"
-                           "健康な尿の色は淡黄色から濃い黄色の範囲です。尿の色が透明や淡い黄色である場合、水分をしっかり摂取している証拠です。"
-                           "日中や運動後には、十分な水分補給を心がけてください。また、朝一番の尿が濃い黄色であっても心配いりません。"
-                           "これは体が夜間に尿を濃縮して水分を保持しようとするためです。<br><br>"
-                           "引き続き、バランスの取れた食事と規則正しい生活を心がけ、健康を維持してください。")
+            with timed('db_write'):
+                db.session.commit()
+            current_app.logger.info(f'画像情報をデータベースに保存しました: {filename}')
+
+            # 同じ画像を同じモデルで判定済みならデコードと推論を省略する
+            model = model_registry.get()
+            model_version = model.version
+            status = prediction_cache.get(content_hash, model_version)
+            if status is None:
+                image = preprocess_upload(data, model.features)
+
+                # 同時に届いた他のリクエストとまとめて、特徴量を作ったときと同じモデルで判定する
+                status, model_version = inference_dispatcher.predict(image, model)
+                prediction_cache.put(content_hash, model_version, status)
+                current_app.logger.info(f'画像処理結果: {status} (model={model_version})')
             else:
-                message = ("検査結果は異常を示しています。<br><br>"
-                           "尿の色が赤色、茶色、または異常に濃い色である場合、何らかの健康問題が考えられます。"
-                           "例えば、赤色の尿は血尿の可能性があり、腎臓や尿路に問題があるかもしれません。"
-                           "茶色の尿は肝臓や胆道の問題を示している可能性があります。<br><br>"
-                           "このような結果が出た場合は、速やかに医師の診察を受けることを強くお勧めします。"
-                           "また、日々の生活習慣を見直し、適切な水分摂取やバランスの取れた食事を心がけましょう。")
-
-            # 日本のタイムゾーンを使用して現在時刻を取得
-            jst = pytz.timezone('Asia/Tokyo')
-            current_time = datetime.now(jst)
-            app.logger.info(f'現在時刻: {current_time}')
+                current_app.logger.info(f'判定済みの結果を使用します: {status} (model={model_version})')
+
+            current_time = now_jst()
+            current_app.logger.info(f'現在時刻: {current_time}')
 
             # 結果をデータベースに保存
-            new_result = Result(status=status, user_id=current_user.id, date=current_time)
+            new_result = Result(status=status, user_id=current_user.id, date=current_time,
+                                model_version=model_version, image_id=new_image.id)
             db.session.add(new_result)
-            db.session.commit()
-            app.logger.info(f'検査結果をデータベースに保存しました: {status}')
+            with timed('db_write'):
+                record_results([new_result])
+                db.session.commit()
+            page_cache.invalidate(current_user.id)
+            current_app.logger.info(f'検査結果をデータベースに保存しました: {status}')
 
             result = {
                 'status': status,
-                'message': message
+                'message': STATUS_MESSAGES[status]
             }
 
             return jsonify(result)
         except Exception as e:
-            app.logger.error(f"画像処理中のエラー: {e}")
+            record_error(e)
+            current_app.logger.error(f"画像処理中のエラー: {e}")
             return jsonify({'error': 'Processing error'})
     
-    app.logger.warning('ファイルがアップロードされませんでした')
+    current_app.logger.warning('ファイルがアップロードされませんでした')
     return jsonify({'error': 'No file uploaded'})
 
-@app.route('/result')
+@bp.route('/upload_images', methods=['POST'])
+@login_required
+def upload_images():
+    files = [file for file in request.files.getlist('images') if file.filename != '']
+    current_app.logger.info(f'一括アップロード開始: {len(files)}件')
+    if not files:
+        current_app.logger.warning('ファイルがアップロードされませんでした')
+        return jsonify({'error': 'No file uploaded'})
+    if len(files) > current_app.config['MAX_BATCH_UPLOAD_FILES']:
+        return jsonify({'error': 'Too many files'}), 413
+
+    results = [{'filename': file.filename} for file in files]
+    accepted = []
+    unscored = {}
+    import numpy as np
+    model = model_registry.get()
+    model_version = model.version
+    vectors = np.empty((len(files), model.features.size), dtype=np.float32)
+    # 画像ごとの読み込みエラーは該当ファイルだけをエラーとして返す
+    for index, file in enumerate(files):
+        if not allowed_file(file.filename):
+            results[index]['error'] = 'File type not allowed'
+            continue
+        metrics.UPLOADS.labels('upload_images').inc()
+        try:
+            filename, data, content_hash, storage_path = receive_upload(file)
+            status = prediction_cache.get(content_hash, model_version)
+            # 判定済みの画像と、同じリクエスト内の重複はデコードしない
+            if status is None and content_hash not in unscored:
+                preprocess_upload(data, model.features, out=vectors[len(unscored)])
+                unscored[content_hash] = len(unscored)
+            accepted.append((index, filename, content_hash, storage_path, status))
+        except Exception as e:
+            record_error(e)
+            current_app.logger.error(f"画像処理中のエラー: {file.filename}: {e}")
+            results[index]['error'] = 'Processing error'
+
+    if accepted:
+        try:
+            scored = {}
+            if unscored:
+                # 未判定の画像をまとめて1回のtransform/predictで判定する
+                # （特徴量を作ったときと同じモデルを使う）
+                statuses = predict_statuses(model, vectors[:len(unscored)])
+                for content_hash, row in unscored.items():
+                    scored[content_hash] = statuses[row]
+                    prediction_cache.put(content_hash, model_version, statuses[row])
+                current_app.logger.info(f'画像処理結果: {statuses} (model={model_version})')
+
+            # 画像と結果は1つのトランザクションでまとめて保存する
+            current_time = now_jst()
+            new_results = []
+            for index, filename, content_hash, storage_path, status in accepted:
+                status = status or scored[content_hash]
+                image = Image(filename=filename, content_hash=content_hash, storage_path=storage_path,
+                              user_id=current_user.id)
+                db.session.add(image)
+                new_results.append(Result(status=status, user_id=current_user.id, date=current_time,
+                                          model_version=model_version, image=image))
+                results[index].update(status=status, message=STATUS_MESSAGES[status])
+            db.session.add_all(new_results)
+            with timed('db_write'):
+                record_results(new_results)
+                db.session.commit()
+            page_cache.invalidate(current_user.id)
+            current_app.logger.info(f'検査結果をデータベースに保存しました: {len(accepted)}件')
+        except Exception as e:
+            record_error(e)
+            db.session.rollback()
+            current_app.logger.error(f"画像処理中のエラー: {e}")
+            return jsonify({'error': 'Processing error'})
+
+    return jsonify({'results': results})
+
+def job_payload(job):
+    payload = {
+        'job_id': job.id,
+        'status': job.status,
+        'status_url': url_for('main.job_status', job_id=job.id),
+    }
+    if current_app.config['JOB_EVENTS']:
+        payload['events_url'] = url_for('main.job_events', job_id=job.id)
+    if job.status == JOB_DONE:
+        payload['result'] = {
+            'status': job.result.status,
+            'message': STATUS_MESSAGES[job.result.status]
+        }
+    elif job.status == JOB_FAILED:
+        payload['error'] = 'Processing error'
+    return payload
+
+@bp.route('/jobs', methods=['POST'])
 @login_required
+def create_job():
+    current_app.logger.info('非同期アップロード開始')
+    file = request.files.get('image')
+    if file is None or file.filename == '':
+        current_app.logger.warning('ファイルがアップロードされませんでした')
+        return jsonify({'error': 'No file uploaded'}), 400
+    if not allowed_file(file.filename):
+        return jsonify({'error': 'File type not allowed'}), 400
+    if not job_runner.has_capacity():
+        # 処理待ちが上限に達している場合はタイムアウトさせずにすぐ断る
+        current_app.logger.warning('処理待ちのジョブが上限に達しています')
+        response = jsonify({'error': 'Server busy'})
+        response.headers['Retry-After'] = '5'
+        return response, 503
+
+    metrics.UPLOADS.labels('create_job').inc()
+    filename, data, content_hash, storage_path = receive_upload(file)
+    new_image = Image(filename=filename, content_hash=content_hash, storage_path=storage_path,
+                      user_id=current_user.id)
+    db.session.add(new_image)
+    db.session.flush()
+    job = job_runner.create(current_user.id, new_image.id)
+
+    # 判定済みの画像ならワーカーに渡さずにその場で完了させる。
+    # このプロセスではモデルを読み込まないので、バージョンはファイルから求める
+    model_version = model_registry.file_version()
+    status = prediction_cache.get(content_hash, model_version) if model_version else None
+    if status is not None:
+        job.result = Result(status=status, user_id=current_user.id, date=now_jst(),
+                            model_version=model_version, image_id=new_image.id)
+        job.status = JOB_DONE
+        job.finished_at = datetime.utcnow()
+        record_results([job.result])
+        db.session.commit()
+        return jsonify(job_payload(job)), 202
+
+    db.session.commit()
+    if not job_runner.submit(job.id, data, on_result=partial(prediction_cache.put, content_hash)):
+        job.status = JOB_FAILED
+        job.error = 'busy'
+        job.finished_at = datetime.utcnow()
+        db.session.commit()
+        response = jsonify({'error': 'Server busy'})
+        response.headers['Retry-After'] = '5'
+        return response, 503
+
+    current_app.logger.info(f'ジョブを登録しました: {job.id}')
+    return jsonify(job_payload(job)), 202
+
+@bp.route('/jobs/<job_id>')
+@login_required
+def job_status(job_id):
+    job = InferenceJob.query.filter_by(id=job_id, user_id=current_user.id).first_or_404()
+    job_runner.expire_stale(job)
+    return jsonify(job_payload(job))
+
+@bp.route('/jobs/<job_id>/events')
+@login_required
+def job_events(job_id):
+    if not current_app.config['JOB_EVENTS']:
+        # 同期ワーカーでは接続中ずっとワーカーを占有するため、ポーリング（/jobs/<id>）を使う
+        return jsonify({'error': 'Events disabled'}), 404
+    InferenceJob.query.filter_by(id=job_id, user_id=current_user.id).first_or_404()
+
+    def stream():
+        # 状態が変わるたびに送信し、完了・失敗したら終了する。
+        # 上限の時間を過ぎたら接続を閉じ、クライアントはポーリングで待ち続ける
+        deadline = time.monotonic() + min(current_app.config['JOB_EVENTS_MAX_SECONDS'],
+                                          current_app.config['JOB_TIMEOUT'])
+        last_status = None
+        while time.monotonic() < deadline:
+            db.session.expire_all()
+            job = db.session.get(InferenceJob, job_id)
+            job_runner.expire_stale(job)
+            if job.status != last_status:
+                last_status = job.status
+                yield f'event: status\ndata: {json.dumps(job_payload(job), ensure_ascii=False)}\n\n'
+            else:
+                yield ': keepalive\n\n'
+            if job.status != JOB_QUEUED:
+                return
+            time.sleep(0.5)
+
+    return Response(stream_with_context(stream()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@bp.route('/metrics')
+def prometheus_metrics():
+    # Prometheusのスクレイプ用。METRICS_TOKEN を設定した場合はBearerトークンを要求する
+    token = current_app.config['METRICS_TOKEN']
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        return Response('Unauthorized', status=401)
+    body, content_type = metrics.export()
+    return Response(body, content_type=content_type)
+
+@bp.route('/model_info')
+@login_required
+def model_info():
+    model = model_registry.get()
+    return jsonify({
+        'version': model.version,
+        'features': model.features.mode,
+        'pca_components': int(model.pca.n_components_) if model.pca is not None else None,
+        'loaded_at': model.loaded_at.isoformat()
+    })
+
+@bp.route('/inference_stats')
+@login_required
+def inference_stats():
+    stats = inference_dispatcher.stats()
+    stats['prediction_cache'] = prediction_cache.stats()
+    return jsonify(stats)
+
+@bp.route('/result')
+@login_required
+@conditional_page
 def result():
-    result = Result.query.filter_by(user_id=current_user.id).order_by(Result.date.desc()).first()
+    result = find_latest_result(current_user.id)
     return render_template('result.html', result=result)
 
-@app.route('/history')
+def find_latest_result(user_id):
+    # (user_id, date DESC, id DESC) のインデックスで先頭の1件だけを読む
+    return (Result.query.filter_by(user_id=user_id)
+            .order_by(Result.date.desc(), Result.id.desc())
+            .first())
+
+def encode_cursor(result):
+    return f'{result.date.isoformat()}_{result.id}'
+
+def decode_cursor(cursor):
+    date, _, result_id = cursor.rpartition('_')
+    return datetime.fromisoformat(date), int(result_id)
+
+def find_history_page(user_id, cursor=None):
+    # キーセット方式のページング。OFFSETを使わないため、履歴の件数によらず1ページの読み込みコストは一定
+    page_size = current_app.config['HISTORY_PAGE_SIZE']
+    query = Result.query.filter_by(user_id=user_id)
+    if cursor:
+        date, result_id = decode_cursor(cursor)
+        query = query.filter(tuple_(Result.date, Result.id) < tuple_(date, result_id))
+    results = query.order_by(Result.date.desc(), Result.id.desc()).limit(page_size + 1).all()
+    next_cursor = encode_cursor(results[page_size - 1]) if len(results) > page_size else None
+    return results[:page_size], next_cursor
+
+@bp.route('/history')
 @login_required
+@conditional_page
 def history():
-    results = Result.query.filter_by(user_id=current_user.id).order_by(Result.date.desc()).all()
-    return render_template('history.html', results=results)
+    # 結果が追加されるまでは、同じページの一覧は描画済みのものを使う
+    cursor = request.args.get('cursor')
+    result_list = page_cache.get(current_user.id, g.page_version, ('history', cursor))
+    if result_list is None:
+        try:
+            results, next_cursor = find_history_page(current_user.id, cursor)
+        except ValueError:
+            return redirect(url_for('main.history'))
+        result_list = render_template('_history_results.html', results=results, next_cursor=next_cursor)
+        page_cache.put(current_user.id, g.page_version, ('history', cursor), result_list)
+    return render_template('history.html', result_list=Markup(result_list))
+
+@bp.route('/history.json')
+@login_required
+def history_json():
+    try:
+        results, next_cursor = find_history_page(current_user.id, request.args.get('cursor'))
+    except ValueError:
+        return jsonify({'error': 'Invalid cursor'}), 400
+    return jsonify({
+        'results': [{
+            'id': result.id,
+            'date': result.date.isoformat(),
+            'status': result.status
+        } for result in results],
+        'next_cursor': next_cursor,
+        'next_url': url_for('main.history_json', cursor=next_cursor) if next_cursor else None
+    })
+
+@bp.route('/trends')
+@login_required
+def trends():
+    period = request.args.get('period', PERIOD_DAY)
+    if period not in (PERIOD_DAY, PERIOD_WEEK):
+        return jsonify({'error': 'Invalid period'}), 400
+    default_periods = 30 if period == PERIOD_DAY else 12
+    periods = min(max(request.args.get('periods', default_periods, type=int), 1), 366)
+    return jsonify({
+        'period': period,
+        'trends': [{
+            'period_start': start.isoformat(),
+            'normal': counts[STATUS_NORMAL],
+            'abnormal': counts[STATUS_ABNORMAL]
+        } for start, counts in find_trends(current_user.id, period, periods)]
+    })
 
-@app.route('/settings', methods=['GET', 'POST'])
+@bp.route('/settings', methods=['GET', 'POST'])
 @login_required
 def settings():
     if request.method == 'POST':
-        user = User.query.get(current_user.id)
+        # current_user はすでにセッションにあるため、ここでSELECTは発生しない
+        user = db.session.get(User, current_user.id)
         user.birthdate = request.form['birthdate']
         user.height = request.form['height']
         user.weight = request.form['weight']
         db.session.commit()
+        user_cache.invalidate(user.id)
         flash('Settings updated successfully.')
-        return redirect(url_for('settings'))
+        return redirect(url_for('main.settings'))
     return render_template('settings.html', user=current_user)
 
-@app.route('/test_write_permission')
+@bp.route('/test_write_permission')
 def test_write_permission():
-    test_file_path = os.path.join(app.config['UPLOAD_FOLDER'], 'test.txt')
+    test_file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], 'test.txt')
     try:
         with open(test_file_path, 'w') as test_file:
             test_file.write("This is a test.")